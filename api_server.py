@@ -1,64 +1,376 @@
 # 描述: 即梦图片生成API服务 (Dify & LobeChat 统一最终版)
 
 import uvicorn
+import os
 import json
+import time
+import signal
+import asyncio
 import logging
+import threading
+import weakref
+from collections import defaultdict
 from fastapi import FastAPI, HTTPException, Header, Request, Depends
-from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, Response, RedirectResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, ValidationError
-from typing import Optional, Dict, Tuple
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, Dict, List, Tuple
+from datetime import datetime
 
-from proxy.jimeng.images import generate_images
+from proxy.jimeng.images import generate_images, add_generation_listener, refresh_image_urls, MAX_IMAGES_PER_REQUEST
+from proxy.jimeng.registry import MODEL_MAP, RATIO_MAP, get_image_dimensions
+from proxy.jimeng.utils import token_split, token_fingerprint
+from proxy.jimeng import breaker, registry, tracing
+from proxy.jimeng.exceptions import API_IMAGE_GENERATION_CANCELLED, API_UPSTREAM_CIRCUIT_OPEN, API_SERVICE_DRAINING
+from history_store import HistoryStore
+from profiling import SamplingProfiler
 
 app = FastAPI(
     title="即梦图片生成统一API",
     version="Unified-Final-Perfect"
 )
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# 链路追踪：设置 JIMENG_TRACE_FILE 后每个请求的span写入该文件（OTLP JSON，按大小轮转）
+TRACE_FILE = os.environ.get("JIMENG_TRACE_FILE", "")
+if TRACE_FILE:
+    tracing.configure(TRACE_FILE)
+# 管理接口口令，未设置时管理接口不可用
+ADMIN_TOKEN = os.environ.get("JIMENG_ADMIN_TOKEN", "")
+profiler = SamplingProfiler(os.environ.get("JIMENG_PROFILE_DIR", "profiles"))
+
+class TracingMiddleware:
+    """为每个HTTP请求开启根span并在响应头返回 X-Trace-Id，被采样的生图请求同时做CPU剖析"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracing.is_enabled() and not profiler.every_n:
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        with tracing.span(f"{scope['method']} {path}", **{"http.method": scope["method"], "http.target": path}) as root:
+            trace_id = root.trace_id if root else os.urandom(16).hex()
+            status = {}
+
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    status["code"] = message["status"]
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [(b"x-trace-id", trace_id.encode())]
+                await send(message)
+
+            sampled = path.startswith("/generate_image") and profiler.should_sample()
+            if sampled:
+                profile_token = profiler.start(trace_id)
+            try:
+                await self.app(scope, receive, send_with_trace_id)
+            finally:
+                if sampled:
+                    profiler.detach(profile_token)
+                    await asyncio.to_thread(profiler.stop, trace_id)
+                if root is not None:
+                    root.set_attribute("http.status_code", status.get("code"))
+
+app.add_middleware(TracingMiddleware)
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True,
-    allow_methods=["*"], allow_headers=["*"],
+    allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Trace-Id"],
 )
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 class ImageRequest(BaseModel):
     prompt: str
     model: Optional[str] = "jimeng-3.0"
     aspect_ratio: Optional[str] = "1:1"
+    n: Optional[int] = Field(None, ge=1, le=MAX_IMAGES_PER_REQUEST)
+    seed: Optional[int] = Field(None, ge=0)
 
-RATIO_MAP: Dict[str, Dict[str, Tuple[int, int]]] = {
-    "jimeng-3.0": {
-        "1:1": (1328, 1328), "16:9": (1664, 936), "9:16": (936, 1664), "4:3": (1472, 1104),
-        "3:4": (1104, 1472), "3:2": (1584, 1056), "2:3": (1056, 1584), "21:9": (2016, 864),
-    },
-    "old_models": {
-        "1:1": (1360, 1360), "16:9": (1360, 765), "9:16": (765, 1360), "4:3": (1360, 1020),
-        "3:4": (1020, 1360), "3:2": (1360, 906), "2:3": (906, 1360), "21:9": (1358, 582),
-    }
-}
 auth_scheme = HTTPBearer()
 
-def get_image_dimensions(model: str, ratio: str) -> Tuple[int, int]:
-    model_group = "jimeng-3.0" if model == "jimeng-3.0" else "old_models"
-    ratios = RATIO_MAP.get(model_group, RATIO_MAP["old_models"])
-    return ratios.get(ratio, ratios["1:1"])
+# 客户端断开后是否让后台任务继续跑完（结果只记录到日志），默认立即取消轮询
+FINISH_ABANDONED_JOBS = os.environ.get("JIMENG_FINISH_ABANDONED", "0") == "1"
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+JOB_STATS: Dict[str, int] = {"completed": 0, "failed": 0, "abandoned": 0, "rejected_circuit_open": 0, "drained": 0}
+
+# 熔断参数可通过 JIMENG_BREAKER_<参数名大写> 环境变量覆盖，如 JIMENG_BREAKER_OPEN_SECONDS=60
+breaker.configure(**{key: os.environ[f"JIMENG_BREAKER_{key.upper()}"]
+                     for key in breaker.CONFIG if f"JIMENG_BREAKER_{key.upper()}" in os.environ})
+BREAKER_TRANSITIONS: List[Dict] = []
+
+def on_breaker_transition(name: str, old_state: str, new_state: str) -> None:
+    # 状态变化写日志并保留最近记录，便于日志告警或轮询 /stats 告警
+    log = logging.warning if new_state == breaker.OPEN else logging.info
+    log(f"上游熔断器 {name} 状态变化: {old_state} -> {new_state}")
+    BREAKER_TRANSITIONS.append({"breaker": name, "from": old_state, "to": new_state, "at": int(time.time())})
+    del BREAKER_TRANSITIONS[:-100]
+
+breaker.add_state_listener(on_breaker_transition)
+
+# 生图历史记录库路径，设为空字符串可关闭历史记录
+HISTORY_DB_PATH = os.environ.get("JIMENG_HISTORY_DB", "history.db")
+history_store: Optional[HistoryStore] = None
+
+# 图片链接刷新：提前 URL_REFRESH_MARGIN 秒刷新即将过期的链接，每批最多 URL_REFRESH_BATCH 个history_id，
+# 过期超过 URL_REFRESH_MAX_AGE 秒的记录不再后台刷新（访问稳定地址时仍会即时尝试）
+URL_REFRESH_INTERVAL = int(os.environ.get("JIMENG_URL_REFRESH_INTERVAL", "300"))
+URL_REFRESH_MARGIN = 3600
+URL_REFRESH_MAX_AGE = int(os.environ.get("JIMENG_URL_REFRESH_MAX_AGE", str(7 * 24 * 3600)))
+URL_REFRESH_BATCH = 50
+# 返回给客户端的稳定图片地址前缀，如 https://img.example.com；不设置时使用请求的地址
+PUBLIC_BASE_URL = os.environ.get("JIMENG_PUBLIC_BASE_URL", "").rstrip("/")
+# token指纹 -> token，仅保存在内存中；JIMENG_API_TOKEN 中的token在重启后也能用于刷新
+known_tokens: Dict[str, str] = {token_fingerprint(t): t for t in token_split(os.environ.get("JIMENG_API_TOKEN", ""))}
+configured_tokens = set(known_tokens)
+
+# 优雅下线：进入drain后拒绝新的生图请求（/ready 返回503，负载均衡切到其他实例），
+# 在途任务最多再跑 DRAIN_GRACE_PERIOD 秒，超时后取消剩余任务
+DRAIN_GRACE_PERIOD = int(os.environ.get("JIMENG_DRAIN_GRACE_PERIOD", "150"))
+# 热加载配置文件(JSON)，可包含 tokens / model_map / ratio_map，通过 /admin/reload 或 SIGHUP 重新加载。
+# 本服务的生图token由客户端在请求中携带，这里的 tokens 只用于后台刷新图片链接；
+# MCP 服务(server.py)使用同一个文件时，tokens 就是它的生图token池
+CONFIG_FILE = os.environ.get("JIMENG_CONFIG_FILE", "")
+drain_state: Dict = {"draining": False, "started_at": None, "cancelled": 0}
+in_flight_jobs: Dict[int, threading.Event] = {}
+# 因drain宽限期到达而被取消的任务，客户端仍在等待，需要与客户端断开区分
+drain_cancelled = weakref.WeakSet()
+
+def _finish_abandoned_job(job: asyncio.Future) -> None:
+    if job.cancelled() or isinstance(job.exception(), API_IMAGE_GENERATION_CANCELLED):
+        return
+    if job.exception() is not None:
+        logging.info(f"已放弃的生成任务最终失败: {job.exception()}")
+    else:
+        logging.info(f"已放弃的生成任务最终完成: {job.result()}")
+
+def generate_in_worker(**kwargs) -> list:
+    # 被采样的请求只剖析执行它的工作线程
+    with profiler.track_thread():
+        return generate_images(**kwargs)
+
+async def run_generation(request: Request, **kwargs) -> list:
+    """在线程池中执行generate_images，客户端断开时取消上游轮询"""
+    cancel_event = threading.Event()
+    job = asyncio.ensure_future(asyncio.to_thread(generate_in_worker, cancel_event=cancel_event, **kwargs))
+    in_flight_jobs[id(job)] = cancel_event
+    job.add_done_callback(lambda j: in_flight_jobs.pop(id(j), None))
+    try:
+        while True:
+            done, _ = await asyncio.wait({job}, timeout=DISCONNECT_CHECK_INTERVAL)
+            if done:
+                break
+            if await request.is_disconnected():
+                JOB_STATS["abandoned"] += 1
+                if not FINISH_ABANDONED_JOBS:
+                    cancel_event.set()
+                job.add_done_callback(_finish_abandoned_job)
+                logging.warning("客户端已断开连接，放弃本次生成请求")
+                raise API_IMAGE_GENERATION_CANCELLED("客户端已断开连接")
+    except asyncio.CancelledError:
+        # 请求协程被取消（如服务关闭）时工作线程不会随之结束，需要通知它停止轮询
+        cancel_event.set()
+        raise
+    try:
+        image_urls = job.result()
+    except API_IMAGE_GENERATION_CANCELLED:
+        if cancel_event in drain_cancelled:
+            JOB_STATS["drained"] += 1
+            raise API_SERVICE_DRAINING("服务正在下线，宽限期已到，生成任务已终止，请重试")
+        JOB_STATS["abandoned"] += 1
+        raise
+    except API_UPSTREAM_CIRCUIT_OPEN:
+        JOB_STATS["rejected_circuit_open"] += 1
+        raise
+    except Exception:
+        JOB_STATS["failed"] += 1
+        raise
+    JOB_STATS["completed"] += 1
+    return image_urls
+
+def draining_error(detail: str) -> HTTPException:
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+def reject_when_draining():
+    if drain_state["draining"]:
+        raise draining_error("服务正在下线，请重试其他实例")
+
+def reload_runtime_config() -> Dict:
+    """重新加载刷新图片链接用的token列表和模型/比例映射，不影响在途请求"""
+    global configured_tokens
+    if not CONFIG_FILE:
+        raise ValueError("未设置 JIMENG_CONFIG_FILE")
+    tokens, model_map, ratio_map = registry.load_config_file(CONFIG_FILE)
+    # 先重建并校验路由表，失败时token也不会被改动
+    if model_map is not None or ratio_map is not None:
+        registry.reload(model_map=model_map, ratio_map=ratio_map)
+    if tokens is not None:
+        fingerprints = {token_fingerprint(t): t for t in tokens}
+        for stale in configured_tokens - set(fingerprints):
+            known_tokens.pop(stale, None)
+        known_tokens.update(fingerprints)
+        configured_tokens = set(fingerprints)
+    summary = {"refresh_tokens": len(configured_tokens), "models": sorted(MODEL_MAP), "ratio_groups": sorted(RATIO_MAP)}
+    logging.info(f"配置已重新加载: {summary}")
+    return summary
+
+def drain_status() -> Dict:
+    elapsed = time.time() - drain_state["started_at"] if drain_state["started_at"] else 0
+    return {"draining": drain_state["draining"], "in_flight": len(in_flight_jobs),
+            "elapsed": round(elapsed, 1), "grace_period": DRAIN_GRACE_PERIOD,
+            "cancelled": drain_state["cancelled"], "drained": drain_state["draining"] and not in_flight_jobs}
+
+async def wait_for_drain():
+    """等待在途任务结束，超过宽限期后取消剩余任务；期间退出drain则直接结束"""
+    deadline = drain_state["started_at"] + DRAIN_GRACE_PERIOD
+    while drain_state["draining"] and in_flight_jobs and time.time() < deadline:
+        await asyncio.sleep(0.5)
+    if not drain_state["draining"]:
+        return
+    if in_flight_jobs:
+        drain_state["cancelled"] += len(in_flight_jobs)
+        logging.warning(f"宽限期已到，取消 {len(in_flight_jobs)} 个未完成的生图任务")
+        for cancel_event in list(in_flight_jobs.values()):
+            drain_cancelled.add(cancel_event)
+            cancel_event.set()
+    logging.info("drain完成，可以安全重启")
+
+def start_drain() -> asyncio.Task:
+    """进入drain并启动宽限期计时，已在drain中时返回现有的计时任务"""
+    if not drain_state["draining"]:
+        drain_state.update(draining=True, started_at=time.time(), cancelled=0)
+        logging.info(f"进入drain，在途任务 {len(in_flight_jobs)} 个")
+        app.state.drain_task = asyncio.create_task(wait_for_drain())
+    return app.state.drain_task
+
+def remember_token(result: Dict) -> None:
+    if result.get("token"):
+        known_tokens[token_fingerprint(result["token"])] = result["token"]
+
+def refresh_expiring_urls(before: int) -> int:
+    """按token分组，通过get_history_by_ids批量刷新即将过期的图片链接
+
+    刷新失败或上游已查不到的记录进入退避，不会反复占用后续批次。
+    """
+    grouped: Dict[str, List[str]] = defaultdict(list)
+    tokens = dict(known_tokens)
+    for history_id, token_hash in history_store.expiring(int(time.time()) - URL_REFRESH_MAX_AGE, before, list(tokens)):
+        grouped[token_hash].append(history_id)
+    refreshed_count = 0
+    for token_hash, history_ids in grouped.items():
+        for i in range(0, len(history_ids), URL_REFRESH_BATCH):
+            chunk = history_ids[i:i + URL_REFRESH_BATCH]
+            try:
+                refreshed = refresh_image_urls(chunk, tokens[token_hash])
+            except Exception as e:
+                logging.warning(f"刷新图片链接失败({len(chunk)}条): {e}")
+                history_store.mark_refresh_failed(chunk)
+                continue
+            history_store.update_urls(refreshed)
+            history_store.mark_refresh_failed([h for h in chunk if h not in refreshed])
+            refreshed_count += len(refreshed)
+    return refreshed_count
+
+async def url_refresh_loop():
+    while True:
+        await asyncio.sleep(URL_REFRESH_INTERVAL)
+        try:
+            count = await asyncio.to_thread(refresh_expiring_urls, int(time.time()) + URL_REFRESH_MARGIN)
+            if count:
+                logging.info(f"已刷新 {count} 条即将过期的图片链接")
+        except Exception as e:
+            logging.error(f"图片链接刷新任务出错: {e}")
+
+def handle_sighup():
+    try:
+        reload_runtime_config()
+    except Exception as e:
+        logging.error(f"配置重新加载失败，沿用旧配置: {e}")
+
+@app.on_event("startup")
+async def install_reload_signal():
+    if CONFIG_FILE and hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, handle_sighup)
+
+@app.on_event("startup")
+async def install_drain_signal():
+    """SIGTERM 时先进入drain让 /ready 返回503，再交给 uvicorn 原有的处理函数停止服务"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        loop.call_soon_threadsafe(start_drain)
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+@app.on_event("shutdown")
+async def cancel_in_flight_jobs():
+    # uvicorn 的宽限期结束后仍未完成的任务：通知工作线程停止轮询，客户端收到与drain超时相同的503
+    drain_state["draining"] = True
+    drain_state["cancelled"] += len(in_flight_jobs)
+    for cancel_event in list(in_flight_jobs.values()):
+        drain_cancelled.add(cancel_event)
+        cancel_event.set()
+
+@app.on_event("startup")
+async def open_history_store():
+    global history_store
+    if HISTORY_DB_PATH:
+        history_store = HistoryStore(HISTORY_DB_PATH)
+        add_generation_listener(history_store.record)
+        add_generation_listener(remember_token)
+        app.state.url_refresh_task = asyncio.create_task(url_refresh_loop())
+
+@app.on_event("shutdown")
+async def close_history_store():
+    if history_store is not None:
+        app.state.url_refresh_task.cancel()
+        await asyncio.to_thread(history_store.close)
+
+@app.get("/stats", include_in_schema=False)
+async def get_stats():
+    return JSONResponse(content={**JOB_STATS, "breakers": breaker.snapshot(), "breaker_transitions": BREAKER_TRANSITIONS})
+
+def stable_image_urls(request: Request, drafts: List[Tuple[str, List[str]]]) -> List[str]:
+    """生成 /images/{history_id}/{index} 稳定地址，顺序与返回的图片URL一致；未启用历史记录时为空"""
+    if history_store is None:
+        return []
+    base_url = PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+    return [f"{base_url}/images/{history_id}/{index}" for history_id, urls in drafts for index in range(len(urls))]
+
+def circuit_open_error(e: Exception) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(breaker.CONFIG["open_seconds"]))})
 
 # --- 为 Dify 提供服务 ---
 @app.get("/openapi.json", include_in_schema=False)
 async def get_openapi_spec():
     return FileResponse('openapi.json')
 
-@app.post("/generate_image_for_dify")
+@app.post("/generate_image_for_dify", dependencies=[Depends(reject_when_draining)])
 async def generate_image_for_dify(
+    request: Request,
     req_body: ImageRequest,
     token: HTTPAuthorizationCredentials = Depends(auth_scheme)
 ):
     width, height = get_image_dimensions(req_body.model, req_body.aspect_ratio)
     logging.info(f"Dify工具收到请求: prompt='{req_body.prompt}', model='{req_body.model}', size='{width}x{height}'")
+    drafts = []
     try:
-        image_urls = generate_images(prompt=req_body.prompt, refresh_token=token.credentials, model=req_body.model, width=width, height=height)
-        return JSONResponse(content={"image_urls": image_urls})
+        image_urls = await run_generation(request, prompt=req_body.prompt, refresh_token=token.credentials, model=req_body.model, width=width, height=height, n=req_body.n, seed=req_body.seed,
+                                          draft_callback=lambda history_id, urls: drafts.append((history_id, urls)))
+        # image_urls 是会过期的签名链接，需要长期保存或嵌入的场景使用 stable_image_urls
+        return JSONResponse(content={"image_urls": image_urls, "stable_image_urls": stable_image_urls(request, drafts)})
+    except API_IMAGE_GENERATION_CANCELLED as e:
+        raise HTTPException(status_code=499, detail=str(e))
+    except API_UPSTREAM_CIRCUIT_OPEN as e:
+        raise circuit_open_error(e)
+    except API_SERVICE_DRAINING as e:
+        raise draining_error(str(e))
     except Exception as e:
         logging.error(f"Dify请求处理失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -68,7 +380,7 @@ async def generate_image_for_dify(
 async def get_lobe_manifest():
     return FileResponse('manifest.json')
 
-@app.post("/generate_image_for_lobe")
+@app.post("/generate_image_for_lobe", dependencies=[Depends(reject_when_draining)])
 async def generate_image_for_lobe(
     request: Request,
     x_lobe_plugin_settings: Optional[str] = Header(None)
@@ -99,13 +411,163 @@ async def generate_image_for_lobe(
 
     width, height = get_image_dimensions(req_body.model, req_body.aspect_ratio)
     logging.info(f"LobeChat插件收到请求: prompt='{req_body.prompt}', model='{req_body.model}', size='{width}x{height}'")
+    drafts = []
     try:
-        image_urls = generate_images(prompt=req_body.prompt, refresh_token=token, model=req_body.model, width=width, height=height)
-        output = "\n\n".join([f"![image]({url})" for url in image_urls])
+        image_urls = await run_generation(request, prompt=req_body.prompt, refresh_token=token, model=req_body.model, width=width, height=height, n=req_body.n, seed=req_body.seed,
+                                          draft_callback=lambda history_id, urls: drafts.append((history_id, urls)))
+        with tracing.span("format_markdown"):
+            # 聊天记录会长期保存，嵌入稳定地址，过期后访问时自动换成新链接
+            output = "\n\n".join([f"![image]({url})" for url in stable_image_urls(request, drafts) or image_urls])
         return Response(content=output, media_type="text/markdown")
+    except API_IMAGE_GENERATION_CANCELLED as e:
+        raise HTTPException(status_code=499, detail=str(e))
+    except API_UPSTREAM_CIRCUIT_OPEN as e:
+        raise circuit_open_error(e)
+    except API_SERVICE_DRAINING as e:
+        raise draining_error(str(e))
     except Exception as e:
         logging.error(f"LobeChat请求处理失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- 健康检查 ---
+@app.get("/health", include_in_schema=False)
+async def health():
+    return JSONResponse(content={"status": "ok"})
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    # drain期间返回503，负载均衡据此把新请求转给其他实例
+    if drain_state["draining"]:
+        return JSONResponse(status_code=503, content=drain_status())
+    return JSONResponse(content={"status": "ready", "in_flight": len(in_flight_jobs)})
+
+# --- 管理接口 ---
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="需要管理口令")
+
+class ProfilingConfig(BaseModel):
+    every_n: int = Field(0, ge=0)
+
+@app.get("/admin/profiling", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def get_profiling():
+    return JSONResponse(content={"every_n": profiler.every_n, "output_dir": profiler.output_dir})
+
+@app.post("/admin/profiling", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def set_profiling(config: ProfilingConfig):
+    """every_n > 0 时每 N 个生图请求采样一次，0 关闭"""
+    profiler.configure(config.every_n)
+    logging.info(f"CPU采样剖析设置为每 {config.every_n} 个请求一次" if config.every_n else "CPU采样剖析已关闭")
+    return JSONResponse(content={"every_n": profiler.every_n})
+
+class DrainRequest(BaseModel):
+    enabled: bool = True
+    wait: bool = False
+
+@app.get("/admin/drain", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def get_drain():
+    return JSONResponse(content=drain_status())
+
+@app.post("/admin/drain", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def set_drain(req: DrainRequest):
+    """enabled=true 进入drain，wait=true 时等到在途任务结束或宽限期到达再返回；enabled=false 恢复接流"""
+    drain_task = getattr(app.state, "drain_task", None)
+    if not req.enabled:
+        drain_state.update(draining=False, started_at=None, cancelled=0)
+        # 旧的宽限期计时不能在恢复接流后再取消新任务
+        if drain_task is not None and not drain_task.done():
+            drain_task.cancel()
+        logging.info("已退出drain，恢复接收请求")
+        return JSONResponse(content=drain_status())
+    drain_task = start_drain()
+    if req.wait:
+        try:
+            await asyncio.shield(drain_task)
+        except asyncio.CancelledError:
+            # drain被另一个请求撤销时正常返回当前状态
+            if not drain_task.cancelled():
+                raise
+    return JSONResponse(content=drain_status())
+
+@app.post("/admin/reload", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def reload_config():
+    try:
+        return JSONResponse(content=reload_runtime_config())
+    except (OSError, ValueError, TypeError, KeyError, IndexError) as e:
+        raise HTTPException(status_code=400, detail=f"配置重新加载失败，沿用旧配置: {e}")
+
+# --- 生图历史检索 ---
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """支持Unix时间戳或ISO日期(如 2024-05-01)"""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"无法解析的时间: {value}")
+
+def caller_fingerprints(token: HTTPAuthorizationCredentials) -> List[str]:
+    # 只能查到自己token提交的记录；Bearer中可以是逗号分隔的多个session_id
+    return [token_fingerprint(t) for t in token_split(token.credentials)]
+
+@app.get("/history")
+async def search_history(
+    q: Optional[str] = None,
+    model: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = 20,
+    token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+):
+    if history_store is None:
+        raise HTTPException(status_code=404, detail="历史记录未启用")
+    limit = max(1, min(limit, 100))
+    result = await asyncio.to_thread(history_store.search, caller_fingerprints(token), q, model, parse_time(start), parse_time(end), cursor, limit)
+    return JSONResponse(content=result)
+
+@app.get("/history/{record_id}")
+async def get_history_record(
+    record_id: int,
+    token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+):
+    if history_store is None:
+        raise HTTPException(status_code=404, detail="历史记录未启用")
+    record = await asyncio.to_thread(history_store.get, record_id, caller_fingerprints(token))
+    if record is None:
+        raise HTTPException(status_code=404, detail="记录不存在")
+    return JSONResponse(content=record)
+
+@app.get("/images/{history_id}/{index}", include_in_schema=False)
+async def resolve_image_url(history_id: str, index: int):
+    """稳定的图片地址：重定向到当前有效的上游链接，链接已过期时先即时刷新"""
+    if history_store is None:
+        raise HTTPException(status_code=404, detail="历史记录未启用")
+    record = await asyncio.to_thread(history_store.get_by_history_id, history_id)
+    if record is None or not 0 <= index < len(record["image_urls"]):
+        raise HTTPException(status_code=404, detail="图片不存在")
+    image_urls = record["image_urls"]
+    now = time.time()
+    # 该接口无需认证，刷新失败后在退避期内不再用存储的token访问上游
+    backing_off = record.get("refresh_after") and record["refresh_after"] > now
+    if record.get("expires_at") and record["expires_at"] <= now + 60 and not backing_off:
+        token = known_tokens.get(record.get("token_hash") or "")
+        if token:
+            try:
+                refreshed = await asyncio.to_thread(refresh_image_urls, [history_id], token)
+            except Exception as e:
+                logging.warning(f"即时刷新图片链接失败 {history_id}: {e}")
+                refreshed = {}
+            if refreshed:
+                await asyncio.to_thread(history_store.update_urls, refreshed)
+                image_urls = refreshed[history_id]
+            else:
+                # 刷新不到时仍重定向到已保存的链接
+                await asyncio.to_thread(history_store.mark_refresh_failed, [history_id])
+    return RedirectResponse(url=image_urls[min(index, len(image_urls) - 1)], status_code=302)
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # SIGTERM 时进入drain（见 install_drain_signal），uvicorn 停止接收新连接，并给在途请求留出与drain相同的宽限期
+    uvicorn.run(app, host="0.0.0.0", port=8001, timeout_graceful_shutdown=DRAIN_GRACE_PERIOD)
\ No newline at end of file
@@ -0,0 +1,82 @@
+# 描述: 模型/尺寸路由的单请求开销基准
+# 对比改造前的实现（逐个正则扫描prompt、嵌套字典查比例、每次现场解析尺寸）与 proxy.jimeng.registry。
+# 用法: python bench_router.py [--number 2000]
+
+import re
+import random
+import timeit
+import argparse
+
+from proxy.jimeng import registry
+
+# --- 改造前的实现，仅用于对比 ---
+LEGACY_MODEL_KEYWORDS = {
+    r'即梦3.0|jimeng-3.0|jimeng 3.0': 'jimeng-3.0',
+    r'即梦2.1|jimeng-2.1|jimeng 2.1': 'jimeng-2.1',
+    r'即梦2.0pro|即梦2.0 pro|jimeng-2.0-pro|jimeng 2.0-pro|jimeng 2.0 pro': 'jimeng-2.0-pro',
+    r'即梦2.0|jimeng-2.0|jimeng 2.0': 'jimeng-2.0',
+    r'即梦1.4|jimeng-1.4|jimeng 1.4': 'jimeng-1.4',
+    r'即梦xlpro|即梦xl pro|jimeng-xl-pro|jimeng xl-pro|jimeng xl pro': 'jimeng-xl-pro'
+}
+
+
+def legacy_find_model_in_prompt(prompt_text):
+    prompt_lower = prompt_text.lower()
+    for pattern, model_name in LEGACY_MODEL_KEYWORDS.items():
+        if re.search(pattern, prompt_lower):
+            return model_name
+    return None
+
+
+def legacy_get_image_dimensions(model, ratio):
+    model_group = "jimeng-3.0" if model == "jimeng-3.0" else "old_models"
+    ratios = registry.RATIO_MAP.get(model_group, registry.RATIO_MAP["old_models"])
+    return ratios.get(ratio, ratios["1:1"])
+
+
+def legacy_parse_size(size):
+    match = re.search(r'(\d+)[\W\w](\d+)', size)
+    width, height = match.groups()
+    return int((int(width) + 1) // 2 * 2), int((int(height) + 1) // 2 * 2)
+
+
+def make_prompt(length, keyword, rng):
+    words = ["一只", "可爱的", "熊猫", "在竹林里", "cinematic", "lighting", "ultra detailed", "水墨风格", "4k", "，"]
+    text = ""
+    while len(text) < length:
+        text += rng.choice(words)
+    return text[:length] + (keyword or "")
+
+
+def per_call_us(func, args, number):
+    return timeit.timeit(lambda: func(*args), number=number) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型/尺寸路由开销基准")
+    parser.add_argument("--number", type=int, default=2000, help="每项重复次数")
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    print(f"{'场景':<36}{'改造前(us)':>12}{'registry(us)':>14}{'加速':>8}")
+    for length in (200, 2000, 20000):
+        # 关键字在末尾或不存在是逐个正则扫描的最坏情况
+        for keyword in (None, "用即梦2.0pro"):
+            prompt = make_prompt(length, keyword, rng)
+            assert legacy_find_model_in_prompt(prompt) == registry.find_model_in_prompt(prompt)
+            number = max(10, args.number * 200 // length)
+            old = per_call_us(legacy_find_model_in_prompt, (prompt,), number)
+            new = per_call_us(registry.find_model_in_prompt, (prompt,), number)
+            label = f"prompt {length}字 {'含' if keyword else '无'}模型关键字"
+            print(f"{label:<36}{old:>12.2f}{new:>14.2f}{old / new:>7.1f}x")
+
+    old = per_call_us(legacy_get_image_dimensions, ("jimeng-2.1", "16:9"), args.number * 50)
+    new = per_call_us(registry.get_image_dimensions, ("jimeng-2.1", "16:9"), args.number * 50)
+    print(f"{'get_image_dimensions':<36}{old:>12.2f}{new:>14.2f}{old / new:>7.1f}x")
+    old = per_call_us(legacy_parse_size, ("1664x936",), args.number * 50)
+    new = per_call_us(registry.parse_size, ("1664x936",), args.number * 50)
+    print(f"{'parse_size':<36}{old:>12.2f}{new:>14.2f}{old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+# 描述: 即梦生图容量规划模拟器（离线离散事件仿真）
+# 按 generate_images 的生命周期建模：提交 -> status 20 排队 -> 每秒轮询 -> 完成/失败/积分耗尽(ret=5000)
+# 用法示例:
+#   python capacity_sim.py --latency latency.json --tokens 8 --concurrency 2 --rate 5000
+#   python capacity_sim.py --latency latency.json --concurrency 2 --rate 5000 --find-tokens --max-p95 60
+#
+# latency.json 中每个阶段可以是从生产日志采样得到的秒数列表，也可以是参数化分布:
+# {
+#   "submit":  [0.8, 1.1, 0.9],                              # 提交 aigc_draft/generate 的耗时
+#   "queue":   {"dist": "lognormal", "mu": 1.5, "sigma": 0.6}, # status 20 排队时长
+#   "render":  {"dist": "uniform", "low": 8, "high": 20},      # 出图时长
+#   "poll":    {"dist": "const", "value": 0.3},                # 单次 get_history_by_ids 耗时
+#   "fail_rate": 0.02,                                         # status 30 失败比例
+#   "exhaust_rate": 0.001,                                     # 单次提交触发 ret=5000 的概率
+#   "images_per_job": 4                                        # 每个任务(一个上游草稿)返回的图片数，默认1
+# }
+# 到达率和吞吐按图片数(张/小时)计，内部按 images_per_job 折算成任务数。
+
+import json
+import math
+import heapq
+import random
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+# 与 images.generate_images 的轮询节奏一致：每秒查询一次，最多120次
+POLL_INTERVAL = 1.0
+MAX_POLL_COUNT = 120
+
+
+class Distribution:
+    """阶段耗时分布，支持经验采样和常见参数化分布"""
+
+    def __init__(self, spec, rng: random.Random):
+        self.rng = rng
+        if isinstance(spec, list):
+            if not spec:
+                raise ValueError("经验采样列表不能为空")
+            self.kind, self.samples = "empirical", [float(x) for x in spec]
+        elif isinstance(spec, (int, float)):
+            self.kind, self.value = "const", float(spec)
+        elif isinstance(spec, dict):
+            self.kind = spec.get("dist", "const")
+            self.spec = spec
+            if self.kind == "const":
+                self.value = float(spec.get("value", 0))
+            elif self.kind not in ("lognormal", "uniform", "exponential"):
+                raise ValueError(f"不支持的分布类型: {self.kind}")
+        else:
+            raise ValueError(f"无法解析的分布定义: {spec!r}")
+
+    def sample(self) -> float:
+        if self.kind == "empirical":
+            return self.rng.choice(self.samples)
+        if self.kind == "const":
+            return self.value
+        if self.kind == "lognormal":
+            return self.rng.lognormvariate(self.spec["mu"], self.spec["sigma"])
+        if self.kind == "uniform":
+            return self.rng.uniform(self.spec["low"], self.spec["high"])
+        return self.rng.expovariate(1.0 / self.spec["mean"])
+
+
+class LatencyModel:
+    """一次生成任务各阶段的耗时与失败概率"""
+
+    def __init__(self, config: Dict, seed: Optional[int] = None):
+        rng = random.Random(seed)
+        self.rng = rng
+        self.submit = Distribution(config.get("submit", 1.0), rng)
+        self.queue = Distribution(config.get("queue", 0.0), rng)
+        self.render = Distribution(config.get("render", 15.0), rng)
+        self.poll = Distribution(config.get("poll", 0.3), rng)
+        self.fail_rate = float(config.get("fail_rate", 0.0))
+        self.exhaust_rate = float(config.get("exhaust_rate", 0.0))
+        self.images_per_job = max(1, int(config.get("images_per_job", 1)))
+
+
+def parse_rate_profile(rate: Optional[float], profile: Optional[str]) -> List[Tuple[float, float]]:
+    """解析到达率曲线
+
+    Args:
+        rate: 恒定到达率(张/小时)
+        profile: "时长秒:张每小时,..." 形式的分段曲线，如 "1800:2000,3600:6000"
+
+    Returns:
+        List[Tuple[float, float]]: (分段时长秒, 每秒到达率) 列表
+    """
+    if profile:
+        segments = []
+        for part in profile.split(','):
+            duration, per_hour = part.split(':')
+            segments.append((float(duration), float(per_hour) / 3600))
+        return segments
+    if rate is None:
+        raise ValueError("必须指定 --rate 或 --profile")
+    return [(3600.0, rate / 3600)]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def simulate(
+    model: LatencyModel,
+    tokens: int,
+    concurrency: int,
+    segments: List[Tuple[float, float]],
+) -> Dict:
+    """运行一次仿真
+
+    Args:
+        model: 耗时模型
+        tokens: session token 数量
+        concurrency: 每个token允许的并发任务数
+        segments: 到达率曲线(张/秒)
+
+    Returns:
+        Dict: 吞吐、排队延迟、端到端延迟分位数和上游轮询量
+    """
+    rng = model.rng
+    # 到达的是生图任务，每个任务一次提交返回 images_per_job 张
+    segments = [(duration, per_second / model.images_per_job) for duration, per_second in segments]
+    events = []  # (时间, 序号, 事件类型, 数据)
+    seq = 0
+
+    def push(at: float, kind: str, payload=None):
+        nonlocal seq
+        heapq.heappush(events, (at, seq, kind, payload))
+        seq += 1
+
+    # 按分段泊松过程生成到达事件
+    now, horizon = 0.0, 0.0
+    for duration, per_second in segments:
+        end = horizon + duration
+        if per_second > 0:
+            now = horizon + rng.expovariate(per_second)
+            while now < end:
+                push(now, "arrival")
+                now += rng.expovariate(per_second)
+        horizon = end
+
+    busy = [0] * tokens
+    exhausted = [False] * tokens
+    waiting: List[float] = []
+    wait_head = 0
+    queue_delays, latencies = [], []
+    stats = {"arrivals": 0, "completed": 0, "failed": 0, "timeout": 0, "exhausted": 0, "rejected": 0, "polls": 0, "submits": 0}
+    last_finish = 0.0
+
+    def pick_token() -> Optional[int]:
+        best = None
+        for i in range(tokens):
+            if not exhausted[i] and busy[i] < concurrency and (best is None or busy[i] < busy[best]):
+                best = i
+        return best
+
+    def start(at: float, arrived: float, token: int):
+        busy[token] += 1
+        stats["submits"] += 1
+        queue_delays.append(at - arrived)
+        submitted = at + model.submit.sample()
+        if rng.random() < model.exhaust_rate:
+            push(submitted, "exhausted", (arrived, token))
+            return
+        ready = submitted + model.queue.sample() + model.render.sample()
+        failed = rng.random() < model.fail_rate
+        # 复现 images.generate_images 的轮询节奏：等待1秒后查询一次，最多120次
+        t, polls = submitted, 0
+        while polls < MAX_POLL_COUNT:
+            t += POLL_INTERVAL + model.poll.sample()
+            polls += 1
+            if t >= ready:
+                break
+        stats["polls"] += polls
+        outcome = "failed" if failed and t >= ready else ("done" if t >= ready else "timeout")
+        push(t, outcome, (arrived, token))
+
+    def drain_waiting(at: float):
+        nonlocal wait_head
+        while wait_head < len(waiting):
+            token = pick_token()
+            if token is None:
+                return
+            start(at, waiting[wait_head], token)
+            wait_head += 1
+
+    while events:
+        at, _, kind, payload = heapq.heappop(events)
+        if kind == "arrival":
+            stats["arrivals"] += 1
+            if all(exhausted):
+                stats["rejected"] += 1
+                continue
+            waiting.append(at)
+            drain_waiting(at)
+            continue
+
+        arrived, token = payload
+        busy[token] -= 1
+        last_finish = max(last_finish, at)
+        if kind == "done":
+            stats["completed"] += 1
+            latencies.append(at - arrived)
+        elif kind == "exhausted":
+            stats["exhausted"] += 1
+            exhausted[token] = True
+        else:
+            stats[kind] += 1
+        drain_waiting(at)
+        if all(exhausted):
+            stats["rejected"] += len(waiting) - wait_head
+            wait_head = len(waiting)
+
+    span = max(horizon, last_finish) or 1.0
+    return {
+        **stats,
+        "jobs_per_hour": stats["completed"] / span * 3600,
+        "images_per_hour": stats["completed"] * model.images_per_job / span * 3600,
+        "queue_delay_mean": sum(queue_delays) / len(queue_delays) if queue_delays else 0.0,
+        "queue_delay_p95": percentile(queue_delays, 95),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "polls_per_second": stats["polls"] / span,
+        "simulated_seconds": span,
+    }
+
+
+def find_min_tokens(config: Dict, concurrency: int, segments, max_p95: float, seed: Optional[int], limit: int = 1024) -> Optional[Tuple[int, Dict]]:
+    """找到满足 p95 延迟目标的最少token数"""
+    low, high, best = 1, 1, None
+    # 先倍增找到上界，再二分
+    while high <= limit:
+        result = simulate(LatencyModel(config, seed), high, concurrency, segments)
+        if result["latency_p95"] <= max_p95 and result["rejected"] == 0:
+            best = (high, result)
+            break
+        low, high = high + 1, high * 2
+    if best is None:
+        return None
+    high = best[0] - 1
+    while low <= high:
+        mid = (low + high) // 2
+        result = simulate(LatencyModel(config, seed), mid, concurrency, segments)
+        if result["latency_p95"] <= max_p95 and result["rejected"] == 0:
+            best, high = (mid, result), mid - 1
+        else:
+            low = mid + 1
+    return best
+
+
+def format_report(tokens: int, concurrency: int, result: Dict) -> str:
+    return "\n".join([
+        f"token数: {tokens}, 每token并发: {concurrency}, 模拟时长: {result['simulated_seconds']:.0f}s",
+        f"到达任务: {result['arrivals']}, 完成: {result['completed']}, 失败: {result['failed']}, "
+        f"超时: {result['timeout']}, 积分耗尽: {result['exhausted']}, 拒绝: {result['rejected']}",
+        f"吞吐: {result['images_per_hour']:.1f} 张/小时 ({result['jobs_per_hour']:.1f} 个任务/小时)",
+        f"排队延迟: 平均 {result['queue_delay_mean']:.2f}s, p95 {result['queue_delay_p95']:.2f}s",
+        f"端到端延迟: p50 {result['latency_p50']:.2f}s, p95 {result['latency_p95']:.2f}s, p99 {result['latency_p99']:.2f}s",
+        f"上游调用: 提交 {result['submits']} 次, 轮询 {result['polls']} 次 ({result['polls_per_second']:.2f} 次/秒)",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="即梦生图容量规划模拟器")
+    parser.add_argument("--latency", required=True, help="阶段耗时分布JSON文件")
+    parser.add_argument("--tokens", type=int, default=1, help="session token 数量")
+    parser.add_argument("--concurrency", type=int, default=1, help="每个token的并发任务数")
+    parser.add_argument("--rate", type=float, help="恒定到达率(张/小时)，模拟1小时")
+    parser.add_argument("--profile", help="分段到达率，格式 '时长秒:张每小时,...'")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    parser.add_argument("--find-tokens", action="store_true", help="搜索满足延迟目标的最少token数")
+    parser.add_argument("--max-p95", type=float, default=60.0, help="--find-tokens 使用的p95延迟目标(秒)")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args()
+
+    with open(args.latency, encoding="utf-8") as f:
+        config = json.load(f)
+    segments = parse_rate_profile(args.rate, args.profile)
+
+    if args.find_tokens:
+        found = find_min_tokens(config, args.concurrency, segments, args.max_p95, args.seed)
+        if found is None:
+            print(f"在1024个token以内无法满足 p95 <= {args.max_p95}s")
+            return
+        tokens, result = found
+    else:
+        tokens = args.tokens
+        result = simulate(LatencyModel(config, args.seed), tokens, args.concurrency, segments)
+
+    if args.json:
+        print(json.dumps({"tokens": tokens, "concurrency": args.concurrency, **result}, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(tokens, args.concurrency, result))
+
+
+if __name__ == "__main__":
+    main()
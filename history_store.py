@@ -0,0 +1,333 @@
+# 描述: 生图历史记录库（SQLite + FTS5全文检索）
+# generate_images 的结果通过监听器进入内存队列，由后台线程批量写入，不占用请求路径。
+# 采用 WAL 模式、自增整数主键和按时间/模型的索引，写入为追加操作，数据量增长后插入耗时保持稳定；
+# 分页使用 id 游标而不是 OFFSET，深翻页同样是索引查找。
+# 每条记录保存提交账号的token指纹，查询只返回调用方自己的记录；上游图片URL是带过期时间的签名链接，同时保存过期时间供后台刷新使用。
+
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from proxy.jimeng.utils import token_fingerprint
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5
+MAX_PENDING = 100000
+# 链接中没有 x-expires 参数时假定的有效期
+DEFAULT_URL_TTL = 12 * 3600
+# 刷新失败(上游查不到或请求出错)后的重试间隔，按失败次数翻倍
+REFRESH_BACKOFF = 600
+MAX_REFRESH_BACKOFF = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    created_at INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    model TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    seed INTEGER,
+    history_id TEXT,
+    image_urls TEXT NOT NULL,
+    submit_ms INTEGER,
+    total_ms INTEGER,
+    token_hash TEXT,
+    expires_at INTEGER,
+    refresh_failures INTEGER NOT NULL DEFAULT 0,
+    refresh_after INTEGER
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_generations_created ON generations(created_at);
+CREATE INDEX IF NOT EXISTS idx_generations_model_created ON generations(model, created_at);
+CREATE INDEX IF NOT EXISTS idx_generations_history_id ON generations(history_id);
+CREATE INDEX IF NOT EXISTS idx_generations_token_id ON generations(token_hash, id);
+CREATE INDEX IF NOT EXISTS idx_generations_expires ON generations(expires_at);
+CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts(rowid, prompt) VALUES (new.id, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts(generations_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+END;
+"""
+
+COLUMNS = ("created_at", "prompt", "model", "width", "height", "seed", "history_id", "image_urls", "submit_ms", "total_ms", "token_hash", "expires_at")
+# 早期版本的库缺少的列，启动时补齐
+MIGRATIONS = {"token_hash": "TEXT", "expires_at": "INTEGER",
+              "refresh_failures": "INTEGER NOT NULL DEFAULT 0", "refresh_after": "INTEGER"}
+
+
+def url_expiry(image_urls: List[str], now: Optional[float] = None) -> int:
+    """取一组签名URL中最早的过期时间"""
+    expiries = []
+    for url in image_urls:
+        values = parse_qs(urlparse(url).query).get("x-expires")
+        if values and values[0].isdigit():
+            expiries.append(int(values[0]))
+    if expiries:
+        return min(expiries)
+    return int((now or time.time()) + DEFAULT_URL_TTL)
+
+
+def _to_row(result: Dict) -> Tuple:
+    values = dict(result)
+    values["image_urls"] = json.dumps(result["image_urls"], ensure_ascii=False)
+    values["token_hash"] = token_fingerprint(result["token"]) if result.get("token") else None
+    values["expires_at"] = url_expiry(result["image_urls"], result.get("created_at"))
+    return tuple(values.get(c) for c in COLUMNS)
+
+
+def _fts_tokenizer(conn: sqlite3.Connection) -> str:
+    # trigram 分词支持中文子串检索（SQLite 3.34+），旧版本退回 unicode61
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.tokenizer_probe USING fts5(x, tokenize='trigram')")
+        conn.execute("DROP TABLE temp.tokenizer_probe")
+        return "trigram"
+    except sqlite3.OperationalError:
+        return "unicode61"
+
+
+class HistoryStore:
+    """生图历史记录的批量写入与查询"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=MAX_PENDING)
+        # 已入队未落盘的记录，按history_id查询时可以立即查到，刚返回给客户端的稳定地址不会404
+        self.unflushed: Dict[str, Dict] = {}
+        conn = self._connect()
+        tokenizer = _fts_tokenizer(conn)
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(prompt, content='generations', content_rowid='id', tokenize='{tokenizer}')")
+        conn.executescript(SCHEMA)
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(generations)")}
+        for column, column_type in MIGRATIONS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE generations ADD COLUMN {column} {column_type}")
+        conn.executescript(INDEXES)
+        self.fts_min_length = 3 if tokenizer == "trigram" else 1
+        self.writer_conn = conn
+        self.writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(self, result: Dict) -> None:
+        """供 add_generation_listener 使用，只入队不落盘"""
+        history_id = str(result["history_id"]) if result.get("history_id") else None
+        # 先登记再入队：写入线程可能在 put 返回前就写完并移除登记
+        if history_id:
+            self.unflushed[history_id] = result
+        try:
+            self.pending.put_nowait(result)
+        except queue.Full:
+            if history_id:
+                self.unflushed.pop(history_id, None)
+            logger.warning("历史记录写入队列已满，丢弃一条记录")
+
+    def _write_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            stop = batch[0] is None
+            while not stop and len(batch) < BATCH_SIZE:
+                try:
+                    item = self.pending.get(timeout=FLUSH_INTERVAL)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            rows = [_to_row(r) for r in batch if r is not None]
+            if rows:
+                try:
+                    with self.writer_conn:
+                        self.writer_conn.executemany(
+                            f"INSERT INTO generations ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+                except sqlite3.Error as e:
+                    logger.error(f"历史记录批量写入失败({len(rows)}条): {e}")
+                for r in batch:
+                    if r is not None and r.get("history_id"):
+                        self.unflushed.pop(str(r["history_id"]), None)
+            if stop:
+                return
+
+    def close(self):
+        """写完队列中剩余的记录后关闭"""
+        self.pending.put(None)
+        self.writer.join()
+        self.writer_conn.close()
+
+    def search(
+        self,
+        token_hashes: List[str],
+        text: Optional[str] = None,
+        model: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        cursor: Optional[int] = None,
+        limit: int = 20,
+    ) -> Dict:
+        """按prompt全文、模型和时间范围查询调用方自己的记录，按id倒序分页
+
+        Args:
+            token_hashes: 调用方token指纹，只返回这些token提交的记录
+            text: prompt检索文本
+            model: 模型名称
+            start: 起始时间戳(含)
+            end: 结束时间戳(不含)
+            cursor: 上一页返回的 next_cursor
+            limit: 每页条数
+
+        Returns:
+            Dict: {"items": [...], "next_cursor": int|None}
+        """
+        if not token_hashes:
+            return {"items": [], "next_cursor": None}
+        where = [f"g.token_hash IN ({', '.join('?' * len(token_hashes))})"]
+        params: List = list(token_hashes)
+        source = "generations g"
+        if text:
+            text = text.strip()
+            if len(text) >= self.fts_min_length:
+                source = "generations_fts f JOIN generations g ON g.id = f.rowid"
+                where.append("generations_fts MATCH ?")
+                params.append('"' + text.replace('"', '""') + '"')
+            else:
+                # 不足三个字符时trigram无法匹配，退回LIKE
+                where.append("g.prompt LIKE ?")
+                params.append(f"%{text}%")
+        if model:
+            where.append("g.model = ?")
+            params.append(model)
+        if start is not None:
+            where.append("g.created_at >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("g.created_at < ?")
+            params.append(end)
+        if cursor is not None:
+            where.append("g.id < ?")
+            params.append(cursor)
+        sql = f"SELECT g.* FROM {source} WHERE " + " AND ".join(where)
+        sql += " ORDER BY g.id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        items = [self._to_dict(r) for r in rows[:limit]]
+        next_cursor = items[-1]["id"] if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def expiring(self, after: int, before: int, token_hashes: List[str], limit: int = 1000) -> List[Tuple[str, str]]:
+        """查询过期时间在 [after, before) 内、可以刷新的记录
+
+        过期太久的记录、提交token不在 token_hashes 中的记录和退避中的记录不会返回，
+        避免它们占满每批的名额，使可刷新的记录永远轮不到。
+
+        Args:
+            after: 过期时间下限，更早过期的记录不再刷新
+            before: 过期时间上限
+            token_hashes: 当前可用于刷新的token指纹
+
+        Returns:
+            List[Tuple[str, str]]: (history_id, token_hash) 列表，按过期时间升序
+        """
+        if not token_hashes:
+            return []
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                # 过期时间窗口远小于全表，按 expires_at 索引范围扫描且无需排序
+                "SELECT history_id, token_hash FROM generations INDEXED BY idx_generations_expires "
+                "WHERE expires_at >= ? AND expires_at < ? "
+                f"AND token_hash IN ({', '.join('?' * len(token_hashes))}) "
+                "AND (refresh_after IS NULL OR refresh_after <= ?) ORDER BY expires_at LIMIT ?",
+                (after, before, *token_hashes, int(time.time()), limit)).fetchall()
+        finally:
+            conn.close()
+        return [(row["history_id"], row["token_hash"]) for row in rows]
+
+    def update_urls(self, refreshed: Dict[str, List[str]]) -> None:
+        """在一个事务内批量写回刷新后的URL和新的过期时间"""
+        if not refreshed:
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE generations SET image_urls = ?, expires_at = ?, refresh_failures = 0, refresh_after = NULL "
+                    "WHERE history_id = ?",
+                    [(json.dumps(urls, ensure_ascii=False), url_expiry(urls, now), history_id)
+                     for history_id, urls in refreshed.items()])
+        finally:
+            conn.close()
+
+    def mark_refresh_failed(self, history_ids: List[str]) -> None:
+        """记录刷新失败，按失败次数指数退避后再重试"""
+        if not history_ids:
+            return
+        now = int(time.time())
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE generations SET refresh_failures = refresh_failures + 1, "
+                    "refresh_after = ? + MIN(?, ? << MIN(refresh_failures, 16)) WHERE history_id = ?",
+                    [(now, MAX_REFRESH_BACKOFF, REFRESH_BACKOFF, history_id) for history_id in history_ids])
+        finally:
+            conn.close()
+
+    def get_by_history_id(self, history_id: str) -> Optional[Dict]:
+        result = self.unflushed.get(history_id)
+        if result is not None:
+            return {"history_id": history_id, "image_urls": list(result["image_urls"]),
+                    "token_hash": token_fingerprint(result["token"]) if result.get("token") else None,
+                    "expires_at": url_expiry(result["image_urls"], result.get("created_at")), "refresh_after": None}
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM generations WHERE history_id = ?", (history_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._to_dict(row, internal=True) if row else None
+
+    def get(self, record_id: int, token_hashes: List[str]) -> Optional[Dict]:
+        """按id查询，记录不属于 token_hashes 中任一token时返回None"""
+        if not token_hashes:
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f"SELECT * FROM generations WHERE id = ? AND token_hash IN ({', '.join('?' * len(token_hashes))})",
+                (record_id, *token_hashes)).fetchone()
+        finally:
+            conn.close()
+        return self._to_dict(row) if row else None
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row, internal: bool = False) -> Dict:
+        # token指纹和刷新退避状态只供服务内部使用，不返回给查询接口
+        item = dict(row)
+        if not internal:
+            item.pop("token_hash", None)
+            item.pop("refresh_failures", None)
+            item.pop("refresh_after", None)
+        item["image_urls"] = json.loads(item["image_urls"])
+        return item
@@ -0,0 +1,137 @@
+# 描述: 按需采样的CPU剖析
+# 通过管理接口开启后，每 N 个生图请求采样一次：请求处理期间后台线程定时抓取该请求工作线程的调用栈，
+# 请求结束后按 trace id 输出 collapsed stacks（flamegraph.pl / speedscope 可直接读取）。
+# 只采样通过 track_thread() 登记到该请求的线程，并且只记录两次采样之间确实消耗了CPU的样本，
+# 轮询间隔里的等待不会出现在结果中；不支持线程CPU时钟的平台退回按栈顶函数过滤等待帧。
+
+import os
+import sys
+import time
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005
+MAX_STACK_DEPTH = 64
+# 栈顶为这些函数时视为空闲等待（仅在无法读取线程CPU时钟时使用）
+IDLE_FUNCTIONS = {"wait", "select", "poll", "sleep", "acquire", "get", "_wait_for_tstate_lock"}
+
+# 当前请求的剖析id，asyncio.to_thread 会把它带到工作线程
+_current_profile: contextvars.ContextVar = contextvars.ContextVar("profile_id", default=None)
+
+
+def _thread_cpu_time(ident: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class SamplingProfiler:
+    """每 N 个请求采样一次的栈采样器"""
+
+    def __init__(self, output_dir: str = "profiles"):
+        self.output_dir = output_dir
+        self.every_n = 0  # 0 表示关闭
+        self.request_count = 0
+        self.active: Dict[str, Counter] = {}
+        self.threads: Dict[str, Set[int]] = {}
+        self.lock = threading.Lock()
+        self.sampler: Optional[threading.Thread] = None
+
+    def configure(self, every_n: int) -> None:
+        with self.lock:
+            self.every_n = max(0, every_n)
+            self.request_count = 0
+
+    def should_sample(self) -> bool:
+        with self.lock:
+            if not self.every_n:
+                return False
+            self.request_count += 1
+            return self.request_count % self.every_n == 0
+
+    def start(self, profile_id: str) -> contextvars.Token:
+        """开始采样，并把 profile_id 设为当前上下文的剖析id，返回值在请求结束时交给 detach()"""
+        with self.lock:
+            self.active[profile_id] = Counter()
+            self.threads[profile_id] = set()
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self._sample_loop, name="cpu-profiler", daemon=True)
+                self.sampler.start()
+        return _current_profile.set(profile_id)
+
+    @contextmanager
+    def track_thread(self) -> Iterator[None]:
+        """在工作线程中包住请求的实际处理，当前请求被采样时登记本线程"""
+        profile_id = _current_profile.get()
+        ident = threading.get_ident()
+        with self.lock:
+            tracked = self.threads.get(profile_id)
+            if tracked is not None:
+                tracked.add(ident)
+        try:
+            yield
+        finally:
+            if tracked is not None:
+                with self.lock:
+                    tracked.discard(ident)
+
+    @staticmethod
+    def detach(token: contextvars.Token) -> None:
+        """在调用 start() 的上下文中复位剖析id"""
+        _current_profile.reset(token)
+
+    def stop(self, profile_id: str) -> Optional[str]:
+        """结束采样并写出 collapsed stacks，返回文件路径"""
+        with self.lock:
+            stacks = self.active.pop(profile_id, None)
+            self.threads.pop(profile_id, None)
+        if not stacks:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{profile_id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"CPU剖析结果已写入 {path}")
+        return path
+
+    def _sample_loop(self):
+        cpu_times: Dict[int, float] = {}
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.sampler = None
+                    return
+                targets = [(self.active[pid], set(idents)) for pid, idents in self.threads.items() if idents]
+            if targets:
+                frames = sys._current_frames()
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for counter, idents in targets:
+                    for ident in idents:
+                        frame = frames.get(ident)
+                        if frame is None or not self._on_cpu(ident, frame, cpu_times):
+                            continue
+                        stack = []
+                        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                            code = frame.f_code
+                            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                            frame = frame.f_back
+                        counter[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    @staticmethod
+    def _on_cpu(ident: int, frame, cpu_times: Dict[int, float]) -> bool:
+        """距上次采样该线程是否消耗了CPU"""
+        cpu = _thread_cpu_time(ident)
+        if cpu is None:
+            return frame.f_code.co_name not in IDLE_FUNCTIONS
+        last = cpu_times.get(ident)
+        cpu_times[ident] = cpu
+        return last is not None and cpu > last
@@ -0,0 +1,262 @@
+#作者：凌封 (微信fengin)
+#GITHUB: https://github.com/fengin/image-gen-server.git
+#相关知识可以看AI全书：https://aibook.ren
+
+
+"""批量生图命令行工具
+
+从CSV/JSONL读取prompt，按token池并发生成，结果逐条追加写入manifest(JSONL)。
+中断后用同一个manifest重新运行即可续跑：已完成的行会被跳过，已提交未完成的行会用提交它的token继续轮询。
+manifest中只记录token指纹，续跑时按指纹找回token，与 --tokens 的顺序无关。
+
+输入每行支持以下字段:
+    prompt  必填，图片描述
+    id      可选，行标识，缺省为行号
+    model   可选，支持 chat.parse_model 的 "model:WxH" 写法，如 "jimeng-3.0:1664x936:n=4:seed=42"，
+            n 超过单草稿上限时拆成多个草稿提交，manifest 中逐个记录
+    size    可选，单独指定 "WxH"，会拼接到 model 后面并覆盖其中的尺寸
+
+用法:
+    python bulk.py --input prompts.csv --manifest results.jsonl --tokens token1,token2 --concurrency 2
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+from typing import Dict, Iterator, List, Optional
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))  # 添加proxy目录到模块搜索路径
+
+from jimeng import utils
+from jimeng.chat import parse_model
+from jimeng.images import submit_generation, wait_for_images, draft_counts, DEFAULT_MODEL, MAX_IMAGES_PER_REQUEST
+from jimeng.exceptions import API_IMAGE_GENERATION_INSUFFICIENT_POINTS
+
+PROGRESS_INTERVAL = 2
+IDLE_WAIT = 0.5
+
+
+def read_rows(path: str) -> Iterator[Dict]:
+    """读取CSV或JSONL输入文件
+
+    Args:
+        path: 输入文件路径，按扩展名区分格式
+
+    Yields:
+        Dict: 包含 id/prompt/model 的行
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(path, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    for line_no, row in enumerate(rows, 1):
+        prompt = (row.get('prompt') or '').strip()
+        if not prompt:
+            continue
+        model = (row.get('model') or DEFAULT_MODEL).strip()
+        size = (row.get('size') or '').strip()
+        if size:
+            model = f"{model}:{size}"
+        yield {'id': str(row.get('id') or line_no), 'prompt': prompt, 'model': model}
+
+
+def load_manifest(path: str) -> Dict[str, Dict]:
+    """回放manifest，得到每行的最新状态"""
+    states = {}
+    if not os.path.exists(path):
+        return states
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 上次中断时写了一半的行
+            states[entry['id']] = entry
+    return states
+
+
+class BulkRunner:
+    """按token池并发执行批量任务，并把状态增量写入manifest"""
+
+    def __init__(self, tokens: List[str], concurrency: int, manifest_path: str):
+        self.tokens = tokens
+        self.token_indexes = {utils.token_fingerprint(t): i for i, t in enumerate(tokens)}
+        self.concurrency = concurrency
+        self.manifest = open(manifest_path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        # 续跑的任务必须由提交时的那个token轮询
+        self.resume_queues = [queue.Queue() for _ in tokens]
+        self.exhausted = [False] * len(tokens)
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        # 尚未写入 done/failed 的行数，归零前空闲的worker不退出，等待被交还的行
+        self.outstanding = 0
+        self.started_at = time.time()
+
+    def record(self, row: Dict, status: str, **fields):
+        entry = {'id': row['id'], 'status': status, 'prompt': row['prompt'], 'model': row['model'],
+                 'ts': utils.get_timestamp(), **fields}
+        with self.lock:
+            self.manifest.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.manifest.flush()
+            if status == 'done':
+                self.done += 1
+            elif status == 'failed':
+                self.failed += 1
+            if status in ('done', 'failed'):
+                self.outstanding -= 1
+
+    def add(self, row: Dict, state: Optional[Dict]) -> bool:
+        """加入待处理行；已提交但提交它的token不在本次token池中时返回False，不重新提交"""
+        if state and state['status'] == 'submitted':
+            token_index = self.token_indexes.get(state.get('token_hash'))
+            if token_index is None:
+                return False
+            self.resume_queues[token_index].put((row, state['history_ids']))
+        else:
+            self.pending.put(row)
+        self.total += 1
+        self.outstanding += 1
+        return True
+
+    def next_job(self, token_index: int):
+        try:
+            return self.resume_queues[token_index].get_nowait()
+        except queue.Empty:
+            pass
+        if self.exhausted[token_index]:
+            return None  # 积分耗尽的token只继续轮询自己已提交的行
+        try:
+            return self.pending.get_nowait(), []
+        except queue.Empty:
+            return None
+
+    def worker(self, token_index: int):
+        token = self.tokens[token_index]
+        token_hash = utils.token_fingerprint(token)
+        while True:
+            job = self.next_job(token_index)
+            if job is None:
+                with self.lock:
+                    finished = self.outstanding <= 0
+                if finished or self.exhausted[token_index]:
+                    return
+                time.sleep(IDLE_WAIT)  # 其他token可能把行交还到 pending
+                continue
+            row, history_ids = job
+            # n 超过单草稿上限时拆成多个草稿，与 generate_images 相同；续跑时只提交尚未提交的草稿
+            model_info = parse_model(row['model'])
+            n = model_info['n']
+            if n is not None and not 1 <= n <= MAX_IMAGES_PER_REQUEST:
+                self.record(row, 'failed', error=f"n must be between 1 and {MAX_IMAGES_PER_REQUEST}")
+                continue
+            counts = draft_counts(n)
+            seed = model_info['seed']
+            history_ids = list(history_ids)
+            try:
+                try:
+                    for i in range(len(history_ids), len(counts)):
+                        history_ids.append(submit_generation(row['prompt'], token, model_info['model'],
+                                                             model_info['width'], model_info['height'],
+                                                             seed=seed + i if seed is not None else None,
+                                                             count=counts[i]))
+                        self.record(row, 'submitted', history_ids=history_ids, token_hash=token_hash)
+                except API_IMAGE_GENERATION_INSUFFICIENT_POINTS:
+                    # 积分耗尽的token不再领取新行
+                    self.exhausted[token_index] = True
+                    print(f"\ntoken #{token_index} 积分不足，已停止使用", file=sys.stderr)
+                    if not history_ids:
+                        self.pending.put(row)  # 行交还给其他token
+                        continue
+                    # 已提交的草稿照常取回，未能提交的图片数记为 missing
+
+                image_urls = []
+                for history_id, count in zip(history_ids, counts):
+                    draft_urls = wait_for_images(history_id, token, expected_count=count if model_info['n'] else None)
+                    image_urls.extend(draft_urls[:count] if model_info['n'] else draft_urls)
+                missing = sum(counts[len(history_ids):])
+                self.record(row, 'done', history_ids=history_ids, token_hash=token_hash, image_urls=image_urls,
+                            **({'missing': missing} if missing else {}))
+            except Exception as e:
+                self.record(row, 'failed', history_ids=history_ids, token_hash=token_hash, error=str(e))
+
+    def progress(self, stop: threading.Event):
+        while not stop.wait(PROGRESS_INTERVAL):
+            print('\r' + self.summary(), end='', file=sys.stderr, flush=True)
+        print('\r' + self.summary(), file=sys.stderr, flush=True)
+
+    def summary(self) -> str:
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        finished = self.done + self.failed
+        rate = finished / elapsed
+        remaining = self.total - finished
+        eta = f"{remaining / rate:.0f}s" if rate > 0 else "--"
+        return (f"完成 {self.done}/{self.total}, 失败 {self.failed}, "
+                f"吞吐 {rate * 60:.1f} 条/分钟, 预计剩余 {eta}")
+
+    def run(self):
+        stop = threading.Event()
+        reporter = threading.Thread(target=self.progress, args=(stop,), daemon=True)
+        reporter.start()
+        workers = [threading.Thread(target=self.worker, args=(i,), daemon=True)
+                   for i in range(len(self.tokens)) for _ in range(self.concurrency)]
+        for w in workers:
+            w.start()
+        try:
+            for w in workers:
+                while w.is_alive():
+                    w.join(0.5)  # 保持主线程可被Ctrl+C中断
+        finally:
+            stop.set()
+            reporter.join()
+            self.manifest.close()
+        left = self.pending.qsize()
+        if left:
+            print(f"所有token积分不足，{left} 条未处理，补充积分后重新运行即可续跑", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="即梦批量生图工具")
+    parser.add_argument("--input", required=True, help="CSV或JSONL格式的prompt文件")
+    parser.add_argument("--manifest", required=True, help="结果manifest(JSONL)，重新运行时据此续跑")
+    parser.add_argument("--tokens", default=os.environ.get("JIMENG_API_TOKEN", ""), help="逗号分隔的session_id，默认读取环境变量JIMENG_API_TOKEN")
+    parser.add_argument("--concurrency", type=int, default=1, help="每个token的并发任务数")
+    parser.add_argument("--retry-failed", action="store_true", help="重新执行manifest中失败的行")
+    args = parser.parse_args()
+
+    tokens = utils.token_split(args.tokens)
+    if not tokens:
+        parser.error("请通过 --tokens 或 JIMENG_API_TOKEN 提供至少一个session_id")
+
+    states = load_manifest(args.manifest)
+    runner = BulkRunner(tokens, max(1, args.concurrency), args.manifest)
+    skipped, orphaned = 0, 0
+    for row in read_rows(args.input):
+        state = states.get(row['id'])
+        if state and (state['status'] == 'done' or (state['status'] == 'failed' and not args.retry_failed)):
+            skipped += 1
+            continue
+        if not runner.add(row, state):
+            orphaned += 1
+            print(f"第 {row['id']} 行已提交，但提交它的token不在本次 --tokens 中，已跳过", file=sys.stderr)
+
+    print(f"共 {runner.total} 条待处理，跳过已完成/已失败 {skipped} 条", file=sys.stderr)
+    if orphaned:
+        print(f"{orphaned} 条已提交的行缺少对应token，加回原token后重新运行即可续跑，不会重复提交", file=sys.stderr)
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        print("\n已中断，重新运行相同命令即可续跑", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
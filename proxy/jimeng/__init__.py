@@ -4,13 +4,16 @@
 提供即梦AI的图像生成功能，支持多账号token。
 """
 
-from .images import generate_images
+from .images import generate_images, submit_generation, wait_for_images, refresh_image_urls
 from .chat import create_completion, create_completion_stream
 
 __version__ = "0.0.1"
 
 __all__ = [
     "generate_images",
+    "submit_generation",
+    "wait_for_images",
+    "refresh_image_urls",
     "create_completion",
     "create_completion_stream"
 ] 
\ No newline at end of file
@@ -0,0 +1,155 @@
+#作者：凌封 (微信fengin)
+#GITHUB: https://github.com/fengin/image-gen-server.git
+#相关知识可以看AI全书：https://aibook.ren
+
+
+"""上游熔断器
+
+按接口类型(提交/轮询)整体以及按 接口类型+token 分别统计滑动窗口内的失败率和慢调用率，
+超过阈值后熔断，熔断期间新请求直接抛出 API_UPSTREAM_CIRCUIT_OPEN，不再等待30秒超时。
+只有提交会因熔断失败；已提交任务的轮询遇到熔断时跳过该轮，在轮询上限内继续等待。
+熔断时长结束后进入半开状态，只放行少量探测请求，探测成功则恢复，失败则重新熔断。
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Tuple
+
+from . import utils
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 熔断参数，可通过 configure() 覆盖
+CONFIG = {
+    "window": 60.0,             # 统计窗口(秒)
+    "min_requests": 10,         # 窗口内请求数达到该值才会判断是否熔断
+    "failure_rate": 0.5,        # 失败率阈值
+    "slow_call_seconds": 10.0,  # 超过该耗时的调用视为慢调用
+    "slow_call_rate": 0.8,      # 慢调用率阈值
+    "open_seconds": 30.0,       # 熔断持续时间
+    "half_open_probes": 2,      # 半开状态允许同时进行的探测请求数
+}
+
+StateListener = Callable[[str, str, str], None]
+_state_listeners: List[StateListener] = []
+
+
+def configure(**overrides) -> None:
+    """覆盖熔断参数，未知参数会报错"""
+    for key, value in overrides.items():
+        if key not in CONFIG:
+            raise ValueError(f"未知的熔断参数: {key}")
+        CONFIG[key] = type(CONFIG[key])(value)
+
+
+def add_state_listener(listener: StateListener) -> None:
+    """注册状态变化监听器，参数为 (熔断器名称, 旧状态, 新状态)，可用于告警"""
+    _state_listeners.append(listener)
+
+
+class CircuitBreaker:
+    """单个熔断器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes = 0
+        self.calls: deque = deque()  # (时间, 是否失败, 是否慢调用)
+        self.lock = threading.Lock()
+
+    def _transition(self, new_state: str):
+        old_state, self.state = self.state, new_state
+        if new_state == OPEN:
+            self.opened_at = time.time()
+        if new_state != HALF_OPEN:
+            self.probes = 0
+        self.calls.clear()
+        for listener in _state_listeners:
+            try:
+                listener(self.name, old_state, new_state)
+            except Exception as e:
+                logging.warning(f"熔断状态监听器执行失败: {e}")
+
+    def allow(self) -> bool:
+        """判断是否放行；半开状态下放行的请求会占用一个探测名额"""
+        with self.lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < CONFIG["open_seconds"]:
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probes >= CONFIG["half_open_probes"]:
+                    return False
+                self.probes += 1
+            return True
+
+    def release(self):
+        """放行后未实际发出请求时归还探测名额"""
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def record(self, failed: bool, elapsed: float):
+        slow = elapsed >= CONFIG["slow_call_seconds"]
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self._transition(OPEN if failed or slow else CLOSED)
+                return
+            if self.state == OPEN:
+                return
+            now = time.time()
+            self.calls.append((now, failed, slow))
+            while self.calls and now - self.calls[0][0] > CONFIG["window"]:
+                self.calls.popleft()
+            total = len(self.calls)
+            if total < CONFIG["min_requests"]:
+                return
+            failures = sum(1 for _, f, _ in self.calls if f)
+            slow_calls = sum(1 for _, _, s in self.calls if s)
+            if failures / total >= CONFIG["failure_rate"] or slow_calls / total >= CONFIG["slow_call_rate"]:
+                self._transition(OPEN)
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {"state": self.state, "calls": len(self.calls),
+                    "failures": sum(1 for _, f, _ in self.calls if f)}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def endpoint_kind(uri: str) -> str:
+    """把上游接口归类为 submit / poll，其余按路径区分"""
+    if "aigc_draft/generate" in uri:
+        return "submit"
+    if "get_history_by_ids" in uri:
+        return "poll"
+    return uri.split("?")[0]
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def breakers_for(uri: str, token: str) -> Tuple[CircuitBreaker, CircuitBreaker]:
+    """返回 (接口级, 接口+token级) 两个熔断器，token只以指纹出现在名称中"""
+    kind = endpoint_kind(uri)
+    return get_breaker(kind), get_breaker(f"{kind}:{utils.token_fingerprint(token)}")
+
+
+def snapshot() -> Dict[str, Dict]:
+    """所有熔断器的当前状态"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.snapshot() for b in breakers}
+
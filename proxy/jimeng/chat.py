@@ -5,13 +5,15 @@
 
 """对话补全相关功能"""
 
-import re
 import time
+import asyncio
+import threading
 from typing import Dict, List, Optional, Union, Generator
 import random
 
 from . import utils
 from .images import generate_images, DEFAULT_MODEL
+from .registry import parse_size
 from .exceptions import API_REQUEST_PARAMS_INVALID
 
 MAX_RETRY_COUNT = 3
@@ -19,35 +21,34 @@ RETRY_DELAY = 5000
 
 def parse_model(model: str) -> Dict[str, Union[str, int]]:
     """解析模型参数
+
+    支持 "model:WxH"，并可追加 ":n=数量" 和 ":seed=种子"，如 "jimeng-3.0:1328x1328:n=4:seed=42"
     
     Args:
         model: 模型名称
         
     Returns:
-        Dict: 模型信息
+        Dict: 模型信息，n/seed 未指定时为 None
     """
-    model_name, size = model.split(':') if ':' in model else (model, None)
-    if not size:
-        return {
-            'model': model_name,
-            'width': 1024,
-            'height': 1024
-        }
-        
-    match = re.search(r'(\d+)[\W\w](\d+)', size)
-    if not match:
-        return {
-            'model': model_name,
-            'width': 1024,
-            'height': 1024
-        }
-        
-    width, height = match.groups()
-    return {
+    model_name, *options = model.split(':')
+    info = {
         'model': model_name,
-        'width': int((int(width) + 1) // 2 * 2),  # 确保是偶数
-        'height': int((int(height) + 1) // 2 * 2)  # 确保是偶数
+        'width': 1024,
+        'height': 1024,
+        'n': None,
+        'seed': None
     }
+    for option in options:
+        key, _, value = option.partition('=')
+        if value:
+            if key in ('n', 'seed') and value.isdigit():
+                info[key] = int(value)
+            continue
+
+        size = parse_size(option)  # 宽高已取偶数
+        if size:
+            info['width'], info['height'] = size
+    return info
 
 async def create_completion(
     messages: List[Dict[str, str]],
@@ -82,7 +83,9 @@ async def create_completion(
             prompt=messages[-1]['content'],
             width=model_info['width'],
             height=model_info['height'],
-            refresh_token=refresh_token
+            refresh_token=refresh_token,
+            n=model_info['n'],
+            seed=model_info['seed']
         )
         
         # 构造返回结果
@@ -159,39 +162,64 @@ async def create_completion_stream(
             }]
         }
         
+        # 在线程中生成图像，每张图片一出现就通过队列发送，不等全部完成
+        loop = asyncio.get_running_loop()
+        ready: asyncio.Queue = asyncio.Queue()
+        cancel_event = threading.Event()
+        job = asyncio.ensure_future(asyncio.to_thread(
+            generate_images,
+            model=model_info['model'],
+            prompt=messages[-1]['content'],
+            width=model_info['width'],
+            height=model_info['height'],
+            refresh_token=refresh_token,
+            n=model_info['n'],
+            seed=model_info['seed'],
+            cancel_event=cancel_event,
+            image_callback=lambda url: loop.call_soon_threadsafe(ready.put_nowait, url)
+        ))
+        # 图片回调先于任务结束入队，None 排在所有图片之后
+        job.add_done_callback(lambda _: ready.put_nowait(None))
+
+        def image_chunk(i: int, url: str) -> Dict:
+            return {
+                'id': utils.generate_uuid(),
+                'model': model or model_info['model'],
+                'object': 'chat.completion.chunk',
+                'choices': [{
+                    'index': i + 1,
+                    'delta': {
+                        'role': 'assistant',
+                        'content': f'![image_{i}]({url})\n'
+                    },
+                    'finish_reason': None
+                }]
+            }
+
         try:
-            # 生成图像
-            image_urls = generate_images(
-                model=model_info['model'],
-                prompt=messages[-1]['content'],
-                width=model_info['width'],
-                height=model_info['height'],
-                refresh_token=refresh_token
-            )
-            
-            # 发送图像URL
-            for i, url in enumerate(image_urls):
-                yield {
-                    'id': utils.generate_uuid(),
-                    'model': model or model_info['model'],
-                    'object': 'chat.completion.chunk',
-                    'choices': [{
-                        'index': i + 1,
-                        'delta': {
-                            'role': 'assistant',
-                            'content': f'![image_{i}]({url})\n'
-                        },
-                        'finish_reason': None if i < len(image_urls) - 1 else 'stop'
-                    }]
-                }
-                
+            sent = []
+            while True:
+                url = await ready.get()
+                if url is None:
+                    break
+                sent.append(url)
+                yield image_chunk(len(sent) - 1, url)
+
+            image_urls = job.result()
+            # 轮询中未逐张回调到的图片（如草稿多返回的图片被替换）补发
+            for url in image_urls:
+                if url in sent:
+                    continue
+                sent.append(url)
+                yield image_chunk(len(sent) - 1, url)
+
             # 发送完成消息
             yield {
                 'id': utils.generate_uuid(),
                 'model': model or model_info['model'],
                 'object': 'chat.completion.chunk',
                 'choices': [{
-                    'index': len(image_urls) + 1,
+                    'index': len(sent) + 1,
                     'delta': {
                         'role': 'assistant',
                         'content': '图像生成完成！'
@@ -215,6 +243,10 @@ async def create_completion_stream(
                     'finish_reason': 'stop'
                 }]
             }
+        finally:
+            # 调用方提前停止读取时不再继续轮询
+            if not job.done():
+                cancel_event.set()
     except Exception as e:
         if retry_count < MAX_RETRY_COUNT:
             print(f"Response error: {str(e)}")
@@ -16,7 +16,9 @@ from io import BytesIO
 import random
 
 from . import utils
-from .exceptions import API_REQUEST_FAILED, API_IMAGE_GENERATION_INSUFFICIENT_POINTS
+from . import breaker
+from . import tracing
+from .exceptions import API_REQUEST_FAILED, API_IMAGE_GENERATION_INSUFFICIENT_POINTS, API_UPSTREAM_CIRCUIT_OPEN
 
 MODEL_NAME = "jimeng"
 DEFAULT_ASSISTANT_ID = "513695"
@@ -77,6 +79,19 @@ def request(
     headers: Optional[Dict] = None,
     is_json=True,
     **kwargs
+) -> Dict[str, Any]:
+    with tracing.span("jimeng.request", **{"http.method": method.upper(), "jimeng.endpoint": breaker.endpoint_kind(uri)}):
+        return _request(method, uri, refresh_token, params, data, headers, is_json, **kwargs)
+
+def _request(
+    method: str,
+    uri: str,
+    refresh_token: str,
+    params: Optional[Dict] = None,
+    data: Optional[Any] = None,
+    headers: Optional[Dict] = None,
+    is_json=True,
+    **kwargs
 ) -> Dict[str, Any]:
     token = acquire_token(refresh_token)
 
@@ -97,14 +112,31 @@ def request(
     if params: 
         _params.update(params)
 
+    # 接口级和token级熔断器都放行才发出请求
+    endpoint_breaker, token_breaker = breaker.breakers_for(uri, token)
+    if not endpoint_breaker.allow():
+        raise API_UPSTREAM_CIRCUIT_OPEN(f"{endpoint_breaker.name} 接口已熔断，请稍后重试")
+    if not token_breaker.allow():
+        endpoint_breaker.release()
+        raise API_UPSTREAM_CIRCUIT_OPEN(f"{token_breaker.name} 已熔断，请稍后重试")
+
+    started_at = time.time()
+    failed = True
     try:
         response = requests.request(method=method.lower(), url=full_url, params=_params, data=data if is_json is False else None, json=data if is_json is True else None, headers=_headers, timeout=30, **kwargs)
+        # 4xx 说明上游可用，只有网络错误、5xx和无法解析的响应计入熔断失败
+        failed = response.status_code >= 500
+        span = tracing.current_span()
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
         response.raise_for_status()
 
         content_type = response.headers.get('content-type', '')
         if 'application/json' in content_type:
             result_text = decompress_response(response)
+            failed = True
             result = json.loads(result_text)
+            failed = False
 
             ret = result.get('ret')
             if ret is not None and str(ret) != '0':
@@ -122,6 +154,10 @@ def request(
         raise API_REQUEST_FAILED("响应格式错误，无法解析JSON")
     except Exception as e: 
         raise e
+    finally:
+        elapsed = time.time() - started_at
+        endpoint_breaker.record(failed, elapsed)
+        token_breaker.record(failed, elapsed)
 
 def _hmac_sha256(key: bytes, msg: str) -> bytes: 
     return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
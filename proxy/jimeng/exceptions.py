@@ -23,7 +23,10 @@ EXCEPTIONS = {
     "API_CONTENT_FILTERED": [-2006, '内容由于合规问题已被阻止生成'],
     "API_IMAGE_GENERATION_FAILED": [-2007, '图像生成失败'],
     "API_VIDEO_GENERATION_FAILED": [-2008, '视频生成失败'],
-    "API_IMAGE_GENERATION_INSUFFICIENT_POINTS": [-2009, '即梦积分不足']
+    "API_IMAGE_GENERATION_INSUFFICIENT_POINTS": [-2009, '即梦积分不足'],
+    "API_IMAGE_GENERATION_CANCELLED": [-2010, '图像生成已取消'],
+    "API_UPSTREAM_CIRCUIT_OPEN": [-2011, '上游服务异常，已暂时熔断'],
+    "API_SERVICE_DRAINING": [-2012, '服务正在下线，生成任务已终止']
 }
 
 # 导出异常类
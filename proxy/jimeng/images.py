@@ -2,74 +2,270 @@
 图像生成相关功能 - 已重构为“文生图”专用最终完美版
 """
 import time
-from typing import List
+import threading
+from typing import Callable, Dict, List, Optional
 import random
 import logging
 import json
 
 from . import utils
-from .core import request
-from .exceptions import API_IMAGE_GENERATION_FAILED, API_CONTENT_FILTERED
-
-# --- 终极修改：移除所有下架和有问题的模型 ---
-MODEL_MAP = {
-    "jimeng-3.0": "high_aes_general_v30l:general_v3.0_18b",
-    "jimeng-2.1": "high_aes_general_v21_L:general_v2.1_L",
-    "jimeng-2.0-pro": "high_aes_general_v20_L:general_v2.0_L",
-}
-DEFAULT_MODEL = "jimeng-3.0"
+from . import tracing
+from .core import request, acquire_token
+from .exceptions import API_IMAGE_GENERATION_FAILED, API_CONTENT_FILTERED, API_IMAGE_GENERATION_CANCELLED, API_UPSTREAM_CIRCUIT_OPEN
+from .registry import DEFAULT_MODEL, resolve_model_id, canonical_model
+
 DRAFT_VERSION = "3.0.2"
+POLL_INTERVAL = 1
+MAX_POLL_COUNT = 120
+# 单个草稿最多请求的图片数，更多的图片拆分为多个草稿并行提交
+MAX_IMAGES_PER_SUBMIT = 4
+MAX_IMAGES_PER_REQUEST = 16
+# 上游仍在处理中的状态码，30为失败
+IN_PROGRESS_STATUSES = (20, 42, 45)
 
-def generate_images(
+# 进度回调: (阶段, 已完成图片数, 图片总数)，阶段为 submitted / queued / rendering / images
+ProgressCallback = Callable[[str, int, int], None]
+# 单张图片就绪时的回调，参数为图片URL
+ImageCallback = Callable[[str], None]
+# 单个草稿完成时的回调: (history_record_id, 该草稿计入结果的图片URL)，可据此生成 /images/{history_id}/{index} 稳定地址
+DraftCallback = Callable[[str, List[str]], None]
+
+# 生成成功后的监听器，收到包含prompt/模型/尺寸/seed/URL/耗时的字典，用于历史记录等
+GENERATION_LISTENERS: List[Callable[[Dict], None]] = []
+
+def add_generation_listener(listener: Callable[[Dict], None]) -> None:
+    """注册生成结果监听器，监听器应尽快返回，耗时操作请自行异步处理"""
+    GENERATION_LISTENERS.append(listener)
+
+def _notify_listeners(result: Dict) -> None:
+    for listener in GENERATION_LISTENERS:
+        try:
+            listener(result)
+        except Exception as e:
+            logging.warning(f"生成结果监听器执行失败: {e}")
+
+def draft_counts(n: Optional[int]) -> List[int]:
+    """每个草稿请求的图片数，一个草稿最多 MAX_IMAGES_PER_SUBMIT 张；n 为空时提交一个草稿"""
+    return [min(MAX_IMAGES_PER_SUBMIT, n - i) for i in range(0, n, MAX_IMAGES_PER_SUBMIT)] if n else [1]
+
+def submit_generation(
     prompt: str,
     refresh_token: str,
     model: str = DEFAULT_MODEL,
     width: int = 1024,
     height: int = 1024,
-    file_path: str = None, # 兼容参数，但已禁用
-) -> List[str]:
-    if file_path:
-        raise API_IMAGE_GENERATION_FAILED("此版本已禁用图生图功能。")
-
+    cancel_event: Optional[threading.Event] = None,
+    seed: Optional[int] = None,
+    count: int = 1,
+) -> str:
+    """提交生成任务，返回用于轮询的 history_record_id，count 为本草稿请求的图片数"""
     if not prompt or not isinstance(prompt, str):
         raise ValueError("prompt must be a non-empty string")
     if not refresh_token:
         raise ValueError("refresh_token is required")
 
-    model_id = MODEL_MAP.get(model, MODEL_MAP[DEFAULT_MODEL])
+    with tracing.span("build_payload"):
+        model_id = resolve_model_id(model)
+
+        component_id = utils.generate_uuid()
+        core_param = {
+            "id": utils.generate_uuid(), "model": model_id, "prompt": prompt, 
+            "negative_prompt": "", "seed": seed if seed is not None else random.randint(2500000000, 3500000000), 
+            "sample_strength": 1.0, "image_ratio": 1, 
+            "large_image_info": {"id": utils.generate_uuid(), "height": height, "width": width}
+        }
+        abilities = {"generate": {"id": utils.generate_uuid(), "core_param": core_param, "history_option": {"id": utils.generate_uuid()}}}
+        draft_content = {"type": "draft", "id": utils.generate_uuid(), "min_version": DRAFT_VERSION, "is_from_tsn": True, "version": DRAFT_VERSION, "main_component_id": component_id, "component_list": [{"type": "image_base_component", "id": component_id, "min_version": DRAFT_VERSION, "generate_type": "generate", "aigc_mode": "workbench", "abilities": {"id": utils.generate_uuid(), **abilities}}]}
+        babi_param = utils.url_encode(utils.json_encode({"scenario": "image_video_generation", "feature_key": "aigc_to_image", "feature_entrance": "to_image", "feature_entrance_detail": f"to_image-{model_id}"}))
+        data = {"extend": {"root_model": model_id, "template_id": ""}, "submit_id": utils.generate_uuid(), "metrics_extra": utils.json_encode({"generateCount": count, "promptSource": "custom"}), "draft_content": utils.json_encode(draft_content)}
 
-    component_id = utils.generate_uuid()
-    core_param = {
-        "id": utils.generate_uuid(), "model": model_id, "prompt": prompt, 
-        "negative_prompt": "", "seed": random.randint(2500000000, 3500000000), 
-        "sample_strength": 1.0, "image_ratio": 1, 
-        "large_image_info": {"id": utils.generate_uuid(), "height": height, "width": width}
-    }
-    abilities = {"generate": {"id": utils.generate_uuid(), "core_param": core_param, "history_option": {"id": utils.generate_uuid()}}}
-    draft_content = {"type": "draft", "id": utils.generate_uuid(), "min_version": DRAFT_VERSION, "is_from_tsn": True, "version": DRAFT_VERSION, "main_component_id": component_id, "component_list": [{"type": "image_base_component", "id": component_id, "min_version": DRAFT_VERSION, "generate_type": "generate", "aigc_mode": "workbench", "abilities": {"id": utils.generate_uuid(), **abilities}}]}
-    babi_param = utils.url_encode(utils.json_encode({"scenario": "image_video_generation", "feature_key": "aigc_to_image", "feature_entrance": "to_image", "feature_entrance_detail": f"to_image-{model_id}"}))
-    data = {"extend": {"root_model": model_id, "template_id": ""}, "submit_id": utils.generate_uuid(), "metrics_extra": utils.json_encode({"generateCount": 1, "promptSource": "custom"}), "draft_content": utils.json_encode(draft_content)}
+    if cancel_event is not None and cancel_event.is_set():
+        raise API_IMAGE_GENERATION_CANCELLED("客户端已取消，未提交生成任务")
 
     result = request("POST", "/mweb/v1/aigc_draft/generate", refresh_token, params={"babi_param": babi_param}, data=data)
 
     history_id = result.get('aigc_data', {}).get('history_record_id')
     if not history_id:
         raise API_IMAGE_GENERATION_FAILED(f"未能获取到历史记录ID: {result}")
+    return history_id
+
+def _record_progress(record: dict, expected: Optional[int] = None) -> tuple:
+    """从轮询结果中提取上游进度"""
+    item_list = record.get('item_list') or []
+    total = expected or record.get('total_image_count') or len(item_list) or 1
+    finished = record.get('finished_image_count')
+    if finished is None:
+        finished = sum(1 for item in item_list if item and item.get('image', {}).get('large_images'))
+    finished = min(finished, total)
+    if record.get('status') == 20:
+        return ("queued", finished, total)
+    return ("images" if finished else "rendering", finished, total)
+
+def _extract_image_urls(record: dict) -> List[str]:
+    item_list = record.get('item_list') or []
+    return [item.get('image', {}).get('large_images', [{}])[0].get('image_url') 
+            for item in item_list if item and item.get('image', {}).get('large_images', [{}])[0].get('image_url')]
+
+def refresh_image_urls(history_ids: List[str], refresh_token: str) -> Dict[str, List[str]]:
+    """批量重新获取已完成任务的图片URL（上游返回的是会过期的签名链接）
+
+    Args:
+        history_ids: history_record_id 列表，需属于同一个token
+        refresh_token: 提交这些任务时使用的token
+
+    Returns:
+        Dict[str, List[str]]: history_record_id -> 最新图片URL列表，查询不到的id不会出现
+    """
+    if not history_ids:
+        return {}
+    result = request("POST", "/mweb/v1/get_history_by_ids", refresh_token, data={"history_ids": list(history_ids)})
+    refreshed = {}
+    for history_id in history_ids:
+        record = result.get(str(history_id))
+        image_urls = _extract_image_urls(record) if record else []
+        if image_urls:
+            refreshed[str(history_id)] = image_urls
+    return refreshed
+
+def _poll_history(
+    history_ids: List[str],
+    refresh_token: str,
+    expected_counts: Optional[Dict[str, int]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    progress_callback: Optional[ProgressCallback] = None,
+    image_callback: Optional[ImageCallback] = None,
+) -> Dict[str, List[str]]:
+    """用一次 get_history_by_ids 同时轮询多个任务，直到全部出图"""
+    expected_counts = expected_counts or {}
+    pending = [str(h) for h in history_ids]
+    results: Dict[str, List[str]] = {}
+    seen: Dict[str, List[str]] = {h: [] for h in pending}
+    progress: Dict[str, tuple] = {h: ("submitted", 0, expected_counts.get(h) or 1) for h in pending}
+    last_progress = None
+    with tracing.span("poll_wait", **{"jimeng.drafts": len(pending)}) as poll_span:
+        for poll_count in range(1, MAX_POLL_COUNT + 1):
+            # 客户端断开或MCP调用被取消时，不再继续轮询一个没人会读取的结果
+            if cancel_event is not None:
+                if cancel_event.wait(POLL_INTERVAL):
+                    raise API_IMAGE_GENERATION_CANCELLED(f"客户端已取消，停止轮询: {','.join(pending)}")
+            else:
+                time.sleep(POLL_INTERVAL)
+            try:
+                poll_result = request("POST", "/mweb/v1/get_history_by_ids", refresh_token, data={"history_ids": pending})
+            except API_UPSTREAM_CIRCUIT_OPEN as e:
+                # 熔断只拒绝新提交；已提交的任务已经扣过积分，跳过本轮，在轮询上限内继续等待恢复
+                logging.info(f"轮询已熔断，跳过本轮({poll_count}/{MAX_POLL_COUNT}): {e}")
+                tracing.add_event("poll.skipped_circuit_open", poll=poll_count)
+                continue
+            for history_id in list(pending):
+                record = poll_result.get(history_id)
+                if not record:
+                    continue
+                if record.get('status') == 30:
+                    raise API_IMAGE_GENERATION_FAILED(f"图像生成失败，状态码: {record.get('status')}, 失败码: {record.get('fail_code')}")
+                expected = expected_counts.get(history_id)
+                progress[history_id] = _record_progress(record, expected)
+
+                image_urls = _extract_image_urls(record)
+                if image_callback is not None:
+                    for url in image_urls[len(seen[history_id]):]:
+                        image_callback(url)
+                seen[history_id] = image_urls
+                finished = record.get('status') not in IN_PROGRESS_STATUSES or (expected and len(image_urls) >= expected)
+                if image_urls and finished:
+                    results[history_id] = image_urls
+                    pending.remove(history_id)
+
+            stages = [p[0] for p in progress.values()]
+            done = sum(p[1] for p in progress.values())
+            total = sum(p[2] for p in progress.values())
+            stage = "images" if done else ("queued" if all(st in ("submitted", "queued") for st in stages) else "rendering")
+            if (stage, done, total) != last_progress:
+                # 阶段变化记为span事件，可区分status 20排队和渲染各占多少时间
+                if last_progress is None or stage != last_progress[0]:
+                    tracing.add_event(f"upstream.{stage}", poll=poll_count)
+                last_progress = (stage, done, total)
+                if progress_callback is not None:
+                    progress_callback(stage, done, total)
+            if not pending:
+                if poll_span is not None:
+                    poll_span.set_attribute("jimeng.polls", poll_count)
+                return results
+
+    raise API_IMAGE_GENERATION_FAILED(f"轮询超时，未能在{MAX_POLL_COUNT}秒内获取到生成的图片。")
+
+def wait_for_images(
+    history_id: str,
+    refresh_token: str,
+    cancel_event: Optional[threading.Event] = None,
+    progress_callback: Optional[ProgressCallback] = None,
+    expected_count: Optional[int] = None,
+    image_callback: Optional[ImageCallback] = None,
+) -> List[str]:
+    """轮询已提交任务直到出图，也可用于恢复此前提交但未完成的任务"""
+    expected_counts = {str(history_id): expected_count} if expected_count else None
+    results = _poll_history([history_id], refresh_token, expected_counts, cancel_event, progress_callback, image_callback)
+    return results[str(history_id)]
+
+def generate_images(
+    prompt: str,
+    refresh_token: str,
+    model: str = DEFAULT_MODEL,
+    width: int = 1024,
+    height: int = 1024,
+    file_path: str = None, # 兼容参数，但已禁用
+    cancel_event: Optional[threading.Event] = None, # 调用方置位后立即停止轮询
+    progress_callback: Optional[ProgressCallback] = None, # 上游状态变化时回调
+    n: Optional[int] = None, # 图片数量，不指定时沿用上游默认数量
+    seed: Optional[int] = None, # 随机种子，多个草稿依次使用 seed, seed+1, ...
+    image_callback: Optional[ImageCallback] = None, # 每张图片就绪时回调，可用于逐张返回
+    draft_callback: Optional[DraftCallback] = None, # 每个草稿的结果回调，按返回结果的顺序调用
+) -> List[str]:
+    if file_path:
+        raise API_IMAGE_GENERATION_FAILED("此版本已禁用图生图功能。")
+    if n is not None and not 1 <= n <= MAX_IMAGES_PER_REQUEST:
+        raise ValueError(f"n must be between 1 and {MAX_IMAGES_PER_REQUEST}")
+
+    # 一个草稿最多请求 MAX_IMAGES_PER_SUBMIT 张，超出部分拆成多个草稿，统一轮询
+    counts = draft_counts(n)
+    base_seed = seed if seed is not None else random.randint(2500000000, 3500000000)
 
-    for _ in range(120):
-        time.sleep(1)
-        poll_result = request("POST", "/mweb/v1/get_history_by_ids", refresh_token, data={"history_ids": [history_id]})
-        record = poll_result.get(str(history_id))
-        if record and record.get('status') != 20:
-            if record.get('status') == 30:
-                raise API_IMAGE_GENERATION_FAILED(f"图像生成失败，状态码: {record.get('status')}, 失败码: {record.get('fail_code')}")
+    with tracing.span("generate_images", **{"jimeng.model": model, "jimeng.n": n, "jimeng.width": width, "jimeng.height": height}):
+        # 提交和轮询必须使用同一个账号，history_record_id 只在提交它的账号下可见
+        with tracing.span("acquire_token"):
+            token = acquire_token(refresh_token)
+        started_at = time.time()
+        drafts = []
+        for i, count in enumerate(counts):
+            history_id = str(submit_generation(prompt, token, model, width, height, cancel_event, base_seed + i, count))
+            drafts.append((history_id, base_seed + i, count))
+        submitted_at = time.time()
+        if progress_callback is not None:
+            progress_callback("submitted", 0, n or 1)
 
-            item_list = record.get('item_list', [])
-            if not item_list: continue
+        emitted = 0
+        def on_image(url: str):
+            nonlocal emitted
+            if n is None or emitted < n:
+                emitted += 1
+                image_callback(url)
 
-            image_urls = [item.get('image', {}).get('large_images', [{}])[0].get('image_url') 
-                          for item in item_list if item and item.get('image', {}).get('large_images', [{}])[0].get('image_url')]
-            if image_urls:
-                return image_urls
+        expected_counts = {history_id: count for history_id, _, count in drafts} if n else None
+        results = _poll_history([d[0] for d in drafts], token, expected_counts, cancel_event, progress_callback,
+                                on_image if image_callback is not None else None)
 
-    raise API_IMAGE_GENERATION_FAILED("轮询超时，未能在120秒内获取到生成的图片。")
\ No newline at end of file
+    image_urls = []
+    for history_id, draft_seed, _ in drafts:
+        draft_urls = results[history_id][:n - len(image_urls)] if n else results[history_id]
+        image_urls.extend(draft_urls)
+        if draft_callback is not None and draft_urls:
+            draft_callback(history_id, draft_urls)
+        if GENERATION_LISTENERS and draft_urls:
+            _notify_listeners({
+                "prompt": prompt, "model": canonical_model(model),
+                "width": width, "height": height, "seed": draft_seed, "history_id": history_id,
+                "image_urls": draft_urls, "token": token, "created_at": int(started_at),
+                "submit_ms": int((submitted_at - started_at) * 1000),
+                "total_ms": int((time.time() - started_at) * 1000),
+            })
+    return image_urls
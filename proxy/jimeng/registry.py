@@ -0,0 +1,175 @@
+#作者：凌封 (微信fengin)
+#GITHUB: https://github.com/fengin/image-gen-server.git
+#相关知识可以看AI全书：https://aibook.ren
+
+
+"""模型/比例/尺寸注册表
+
+MCP、HTTP 和对话补全三条入口共用的路由表。加载时校验并预计算:
+- 模型名 -> 上游模型ID、模型名 -> 比例分组、(模型, 比例) -> 尺寸 的 O(1) 查询表
+- 按优先级排好、预先转小写的模型关键字，匹配时只做 C 层的子串查找
+reload() 会先完整构建新表再整体替换，校验失败时沿用旧表。
+"""
+
+import re
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from .utils import token_split
+
+DEFAULT_MODEL = "jimeng-3.0"
+DEFAULT_RATIO = "1:1"
+DEFAULT_RATIO_GROUP = "old_models"
+
+# --- 终极修改：移除所有下架和有问题的模型 ---
+MODEL_MAP: Dict[str, str] = {
+    "jimeng-3.0": "high_aes_general_v30l:general_v3.0_18b",
+    "jimeng-2.1": "high_aes_general_v21_L:general_v2.1_L",
+    "jimeng-2.0-pro": "high_aes_general_v20_L:general_v2.0_L",
+}
+
+RATIO_MAP: Dict[str, Dict[str, Tuple[int, int]]] = {
+    "jimeng-3.0": {
+        "1:1": (1328, 1328), "16:9": (1664, 936), "9:16": (936, 1664), "4:3": (1472, 1104),
+        "3:4": (1104, 1472), "3:2": (1584, 1056), "2:3": (1056, 1584), "21:9": (2016, 864),
+    },
+    "old_models": {
+        "1:1": (1360, 1360), "16:9": (1360, 765), "9:16": (765, 1360), "4:3": (1360, 1020),
+        "3:4": (1020, 1360), "3:2": (1360, 906), "2:3": (906, 1360), "21:9": (1358, 582),
+    }
+}
+
+# 模型使用的比例分组，未列出的模型使用 DEFAULT_RATIO_GROUP
+MODEL_RATIO_GROUP: Dict[str, str] = {"jimeng-3.0": "jimeng-3.0"}
+
+# prompt 中的模型关键字（小写匹配），先列出的模型优先，如同时出现“即梦3.0”和“即梦2.1”时选3.0
+MODEL_KEYWORDS: Dict[str, List[str]] = {
+    "jimeng-3.0": ["即梦3.0", "jimeng-3.0", "jimeng 3.0"],
+    "jimeng-2.1": ["即梦2.1", "jimeng-2.1", "jimeng 2.1"],
+    "jimeng-2.0-pro": ["即梦2.0pro", "即梦2.0 pro", "jimeng-2.0-pro", "jimeng 2.0-pro", "jimeng 2.0 pro"],
+}
+
+SIZE_PATTERN = re.compile(r'(\d+)[\W\w](\d+)')
+
+
+class _Tables:
+    """一次加载得到的全部查询表，构建时完成校验"""
+
+    def __init__(self, model_map: Dict[str, str], ratio_map: Dict[str, Dict[str, Tuple[int, int]]],
+                 model_ratio_group: Dict[str, str], model_keywords: Dict[str, List[str]]):
+        if DEFAULT_MODEL not in model_map:
+            raise ValueError(f"模型表缺少默认模型 {DEFAULT_MODEL}")
+        if DEFAULT_RATIO_GROUP not in ratio_map:
+            raise ValueError(f"比例表缺少 {DEFAULT_RATIO_GROUP} 分组")
+        for group, ratios in ratio_map.items():
+            if DEFAULT_RATIO not in ratios:
+                raise ValueError(f"比例分组 {group} 缺少 {DEFAULT_RATIO}")
+        for model, group in model_ratio_group.items():
+            if group not in ratio_map:
+                raise ValueError(f"模型 {model} 使用了不存在的比例分组 {group}")
+        for model in model_keywords:
+            if model not in model_map:
+                raise ValueError(f"关键字指向了模型表中不存在的模型 {model}")
+
+        self.model_ids = dict(model_map)
+        self.dimensions: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self.default_dimensions: Dict[str, Tuple[int, int]] = {}
+        for model in model_map:
+            ratios = ratio_map[model_ratio_group.get(model, DEFAULT_RATIO_GROUP)]
+            self.default_dimensions[model] = ratios[DEFAULT_RATIO]
+            for ratio, size in ratios.items():
+                self.dimensions[(model, ratio)] = size
+        self.fallback_ratios = ratio_map[DEFAULT_RATIO_GROUP]
+        self.keywords: Tuple[Tuple[str, Tuple[str, ...]], ...] = tuple(
+            (model, tuple(keyword.lower() for keyword in keywords)) for model, keywords in model_keywords.items())
+
+
+_tables = _Tables(MODEL_MAP, RATIO_MAP, MODEL_RATIO_GROUP, MODEL_KEYWORDS)
+
+
+def reload(model_map: Optional[Dict[str, str]] = None,
+           ratio_map: Optional[Dict[str, Dict[str, Tuple[int, int]]]] = None) -> None:
+    """替换模型/比例表；新表校验失败时抛出 ValueError 且不做任何修改
+
+    关键字中指向已下线模型的条目会被丢弃，而不是导致整次加载失败。
+    """
+    global _tables
+    new_model_map = dict(model_map) if model_map is not None else dict(MODEL_MAP)
+    new_ratio_map = dict(ratio_map) if ratio_map is not None else dict(RATIO_MAP)
+    keywords = {model: words for model, words in MODEL_KEYWORDS.items() if model in new_model_map}
+    groups = {model: group for model, group in MODEL_RATIO_GROUP.items() if model in new_model_map}
+    tables = _Tables(new_model_map, new_ratio_map, groups, keywords)
+    # 原地更新，已经 import 这些字典的模块也能看到新值
+    MODEL_MAP.clear()
+    MODEL_MAP.update(new_model_map)
+    RATIO_MAP.clear()
+    RATIO_MAP.update(new_ratio_map)
+    _tables = tables
+
+
+def load_config_file(path: str) -> Tuple[Optional[List[str]], Optional[Dict[str, str]], Optional[Dict[str, Dict[str, Tuple[int, int]]]]]:
+    """读取热加载配置文件(JSON)，返回 (tokens, model_map, ratio_map)，未配置的项为None
+
+    tokens 可以是逗号分隔的字符串或列表；模型/比例表的完整校验由 reload() 负责。
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    tokens = config.get("tokens")
+    if tokens is not None:
+        tokens = token_split(tokens) if isinstance(tokens, str) else [t.strip() for t in tokens if t.strip()]
+    model_map = config.get("model_map")
+    ratio_map = config.get("ratio_map")
+    if ratio_map is not None:
+        ratio_map = {group: {ratio: (int(size[0]), int(size[1])) for ratio, size in ratios.items()}
+                     for group, ratios in ratio_map.items()}
+    return tokens, model_map, ratio_map
+
+
+def resolve_model_id(model: str) -> str:
+    """模型名 -> 上游模型ID，未知模型记录告警后使用默认模型"""
+    tables = _tables
+    model_id = tables.model_ids.get(model)
+    if model_id is None:
+        logging.warning(f"未知模型 {model}，使用默认模型 {DEFAULT_MODEL}")
+        model_id = tables.model_ids[DEFAULT_MODEL]
+    return model_id
+
+
+def canonical_model(model: str) -> str:
+    """未知模型返回默认模型名，与 resolve_model_id 的回退保持一致"""
+    return model if model in _tables.model_ids else DEFAULT_MODEL
+
+
+def get_image_dimensions(model: str, ratio: str) -> Tuple[int, int]:
+    """(模型, 比例) -> (宽, 高)，未知比例使用该模型的 1:1"""
+    tables = _tables
+    size = tables.dimensions.get((model, ratio))
+    if size is not None:
+        return size
+    default = tables.default_dimensions.get(model)
+    if default is not None:
+        return default
+    return tables.fallback_ratios.get(ratio, tables.fallback_ratios[DEFAULT_RATIO])
+
+
+def find_model_in_prompt(prompt_text: str) -> Optional[str]:
+    """返回prompt中提到的模型名，没有则返回None
+
+    关键字是普通字符串，用 `in` 查找比逐个正则扫描快，也不会把 "3.0" 里的点当成通配符。
+    """
+    text = prompt_text.lower()
+    for model, keywords in _tables.keywords:
+        for keyword in keywords:
+            if keyword in text:
+                return model
+    return None
+
+
+def parse_size(text: str) -> Optional[Tuple[int, int]]:
+    """解析 "WxH"，宽高向上取偶数"""
+    match = SIZE_PATTERN.search(text)
+    if not match:
+        return None
+    width, height = match.groups()
+    return (int(width) + 1) // 2 * 2, (int(height) + 1) // 2 * 2
@@ -0,0 +1,148 @@
+#作者：凌封 (微信fengin)
+#GITHUB: https://github.com/fengin/image-gen-server.git
+#相关知识可以看AI全书：https://aibook.ren
+
+
+"""请求级链路追踪
+
+用 contextvars 维护当前 span，asyncio.to_thread 会复制上下文，因此接口处理函数、
+线程中的 generate_images 和 core.request 的 span 能串成一棵树。
+未调用 configure() 时不导出任何数据，span 只是空操作。
+导出格式为 OTLP JSON（每行一个 ResourceSpans），写入按大小轮转的本地文件。
+"""
+
+import os
+import json
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Iterator, List, Optional
+
+SERVICE_NAME = "image-gen-server"
+SCOPE_NAME = "proxy.jimeng"
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("jimeng_current_span", default=None)
+_exporter: Optional[logging.Logger] = None
+
+
+def configure(path: str, max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5) -> None:
+    """开启追踪，span 写入 path，超过 max_bytes 后轮转"""
+    global _exporter
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    exporter = logging.getLogger("jimeng.tracing.exporter")
+    exporter.propagate = False
+    exporter.setLevel(logging.INFO)
+    for handler in list(exporter.handlers):
+        exporter.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    exporter.addHandler(handler)
+    _exporter = exporter
+
+
+def is_enabled() -> bool:
+    return _exporter is not None
+
+
+def _attribute(key: str, value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:
+    """一个计时区间"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.events: List[Dict] = []
+        self.error: Optional[str] = None
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes) -> None:
+        self.events.append({"timeUnixNano": str(time.time_ns()), "name": name,
+                            "attributes": [_attribute(k, v) for k, v in attributes.items()]})
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace_id, "spanId": self.span_id, "name": self.name, "kind": 1,
+            "startTimeUnixNano": str(self.start_ns), "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            "events": self.events,
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+@contextmanager
+def span(name: str, trace_id: Optional[str] = None, **attributes) -> Iterator[Optional[Span]]:
+    """开启一个子 span；没有父 span 时开启新的 trace
+
+    Args:
+        name: span 名称
+        trace_id: 指定 trace id（如沿用客户端传入的值），默认自动生成
+        attributes: span 属性
+    """
+    if _exporter is None:
+        yield None
+        return
+    parent = _current_span.get()
+    if parent is not None:
+        trace_id = parent.trace_id
+    current = Span(name, trace_id or os.urandom(16).hex(), parent.span_id if parent else None, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_ns = time.time_ns()
+        _export(current)
+
+
+def add_event(name: str, **attributes) -> None:
+    """给当前 span 添加事件，未开启追踪时忽略"""
+    current = _current_span.get()
+    if current is not None:
+        current.add_event(name, **attributes)
+
+
+def _export(finished: Span) -> None:
+    exporter = _exporter
+    if exporter is None:
+        return
+    payload = {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": SCOPE_NAME}, "spans": [finished.to_otlp()]}],
+    }]}
+    exporter.info(json.dumps(payload, ensure_ascii=False, separators=(",", ":")))
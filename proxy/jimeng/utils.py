@@ -95,6 +95,17 @@ def token_split(auth: str) -> List[str]:
     auth = auth.replace('Bearer', '').strip()
     return [t.strip() for t in auth.split(',') if t.strip()]
 
+def token_fingerprint(token: str) -> str:
+    """token指纹，用于落盘记录而不保存明文session_id
+    
+    Args:
+        token: session_id
+        
+    Returns:
+        str: sha256前16位
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
 def json_encode(obj: object) -> str:
     """JSON编码
     
@@ -5,20 +5,34 @@
 # 相关知识可以看AI全书：https://aibook.ren
 
 import os
-import re
+import atexit
+import signal
+import asyncio
 import logging
+import threading
 from sys import stdin, stdout
-from fastmcp import FastMCP
+from fastmcp import FastMCP, Context
 import mcp.types as types
 
 # 仅从proxy.jimeng模块导入图片生成器
-from proxy.jimeng.images import generate_images
+from proxy.jimeng.images import generate_images, add_generation_listener
+from proxy.jimeng import registry, tracing
+from history_store import HistoryStore
 
 # ######################################################################
 # 请在这里填入你自己的配置
 # ######################################################################
 # 用于图片生成的即梦 session_id
 JIMENG_API_TOKEN = "057f7addf85dxxxxxxxxxxxxx" # 你登录即梦获得的session_id，支持多个，在后面用逗号分隔 
+# 同时执行的 generate_image 调用上限，超出的调用排队等待
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("JIMENG_MAX_CONCURRENCY", "4"))
+# api_server 的对外地址，如 https://img.example.com。设置后生成记录写入与 api_server 共用的历史库(JIMENG_HISTORY_DB)，
+# 返回 /images/{history_id}/{index} 稳定地址，链接过期后由 api_server 刷新（api_server 的 JIMENG_API_TOKEN 需包含这里的token）
+IMAGE_BASE_URL = os.environ.get("JIMENG_IMAGE_BASE_URL", "").rstrip("/")
+HISTORY_DB_PATH = os.environ.get("JIMENG_HISTORY_DB", "history.db")
+# 热加载配置文件(JSON)，与 api_server 格式相同：tokens 覆盖上面的 JIMENG_API_TOKEN，model_map / ratio_map 覆盖模型表。
+# 启动时加载一次，之后发送 SIGHUP 重新加载，进行中的调用继续使用原来的token
+CONFIG_FILE = os.environ.get("JIMENG_CONFIG_FILE", "")
 # ######################################################################
 
 
@@ -29,8 +43,40 @@ stdout.reconfigure(encoding='utf-8')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 设置 JIMENG_TRACE_FILE 后记录每次工具调用的链路追踪
+if os.environ.get("JIMENG_TRACE_FILE"):
+    tracing.configure(os.environ["JIMENG_TRACE_FILE"])
+
 # 创建FastMCP实例
 mcp = FastMCP("image-gen-cloud-server")
+generation_slots = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+# 工具调用结果计数，客户端取消的调用单独记为 abandoned，随每次调用结束写入日志
+JOB_STATS = {"completed": 0, "failed": 0, "abandoned": 0}
+
+if IMAGE_BASE_URL and HISTORY_DB_PATH:
+    history_store = HistoryStore(HISTORY_DB_PATH)
+    add_generation_listener(history_store.record)
+    atexit.register(history_store.close)
+
+# 上游阶段到MCP进度值的映射，出图阶段在此基础上累加已完成图片数
+PROGRESS_STAGES = {"submitted": 1, "queued": 2, "rendering": 3}
+PROGRESS_MESSAGES = {"submitted": "任务已提交", "queued": "排队中", "rendering": "渲染中"}
+
+def make_progress_reporter(ctx: Context, loop: asyncio.AbstractEventLoop):
+    """把工作线程中的上游进度转成MCP进度通知"""
+    def report(stage: str, done: int, total: int):
+        base = len(PROGRESS_STAGES)
+        progress = PROGRESS_STAGES.get(stage, base + done)
+        message = PROGRESS_MESSAGES.get(stage, f"已完成 {done}/{total} 张图片")
+        asyncio.run_coroutine_threadsafe(ctx.report_progress(progress, base + total), loop)
+        asyncio.run_coroutine_threadsafe(ctx.info(message), loop)
+    return report
+
+def make_image_reporter(ctx: Context, loop: asyncio.AbstractEventLoop):
+    """每张图片就绪时立即通过MCP日志通知推送，无需等全部完成"""
+    def report(url: str):
+        asyncio.run_coroutine_threadsafe(ctx.info(f"图片已就绪: ![Generated Image]({url})"), loop)
+    return report
 
 @mcp.tool("use_description")
 async def list_tools():
@@ -39,67 +85,107 @@ async def list_tools():
         "tools": [
             {
                 "name": "generate_image",
-                "description": "根据文本描述或参考图生成静态图片。默认使用即梦3.0模型。可以直接在prompt中通过说'用即梦2.0'等来指定模型。返回Markdown格式的图片。",
+                "description": "根据文本描述或参考图生成静态图片。默认使用即梦3.0模型。可以直接在prompt中通过说'用即梦2.1'等来指定模型。返回Markdown格式的图片。",
                 "parameters": {
                     "prompt": { "type": "string", "description": "图片的文本描述。可以在描述中包含模型名称，如'用即梦2.0pro画一只猫'。", "required": True },
                     "file_path": { "type": "string", "description": "【图生图】参考图片的本地路径或网络URL(可选)。", "required": False },
                     "model": { "type": "string", "description": "精确选择图片模型(可选, 默认 'jimeng-3.0')。", "required": False },
+                    "n": { "type": "integer", "description": "生成图片数量(可选, 1-16)，不填时使用即梦默认数量。", "required": False },
+                    "seed": { "type": "integer", "description": "随机种子(可选)，相同种子和描述可复现图片。", "required": False },
                 }
             }
         ]
     }
 
+def reload_config(*_):
+    """从 CONFIG_FILE 重新加载生图token池和模型/比例表，失败时沿用旧配置"""
+    global JIMENG_API_TOKEN
+    try:
+        tokens, model_map, ratio_map = registry.load_config_file(CONFIG_FILE)
+        if model_map is not None or ratio_map is not None:
+            registry.reload(model_map=model_map, ratio_map=ratio_map)
+        if tokens:
+            JIMENG_API_TOKEN = ",".join(tokens)
+        logger.info(f"配置已重新加载: token {len(tokens or [])} 个, 模型 {sorted(registry.MODEL_MAP)}")
+    except Exception as e:
+        logger.error(f"配置重新加载失败，沿用旧配置: {e}")
+
+# 放在模块级而不是 __main__ 中，通过 fastmcp run server.py 启动时同样生效
+if CONFIG_FILE:
+    reload_config()
+    # signal.signal 只能在主线程调用，被其他线程导入时仅做一次性加载
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, reload_config)
+
 def find_model_in_prompt(prompt_text: str) -> str:
     """从prompt中智能查找图片模型关键字"""
-    model_keywords = {
-        r'即梦3.0|jimeng-3.0|jimeng 3.0': 'jimeng-3.0',
-        r'即梦2.1|jimeng-2.1|jimeng 2.1': 'jimeng-2.1',
-        r'即梦2.0pro|即梦2.0 pro|jimeng-2.0-pro|jimeng 2.0-pro|jimeng 2.0 pro': 'jimeng-2.0-pro',
-        r'即梦2.0|jimeng-2.0|jimeng 2.0': 'jimeng-2.0',
-        r'即梦1.4|jimeng-1.4|jimeng 1.4': 'jimeng-1.4',
-        r'即梦xlpro|即梦xl pro|jimeng-xl-pro|jimeng xl-pro|jimeng xl pro': 'jimeng-xl-pro'
-    }
-    prompt_lower = prompt_text.lower()
-    for pattern, model_name in model_keywords.items():
-        if re.search(pattern, prompt_lower):
-            logger.info(f"在prompt中检测到图片模型，选用: {model_name}")
-            return model_name
-    return None
+    model_name = registry.find_model_in_prompt(prompt_text)
+    if model_name:
+        logger.info(f"在prompt中检测到图片模型，选用: {model_name}")
+    return model_name
 
 @mcp.tool("generate_image")
 async def generate_image_tool(
     prompt: str,
     file_path: str = None,
     # 将此处的默认值改为 "jimeng-3.0"
-    model: str = "jimeng-3.0"
+    model: str = "jimeng-3.0",
+    n: int = None,
+    seed: int = None,
+    ctx: Context = None
 ) -> list[types.TextContent]:
     
-    logger.info(f"收到图片生成请求: prompt='{prompt}', file_path='{file_path}', model_param='{model}'")
+    logger.info(f"收到图片生成请求: prompt='{prompt}', file_path='{file_path}', model_param='{model}', n={n}, seed={seed}")
     
     # 智能模型选择逻辑保持不变
     final_model = find_model_in_prompt(prompt) or model
     
     if not prompt: return [types.TextContent(text="**错误**: prompt不能为空")]
 
+    cancel_event = threading.Event()
+    loop = asyncio.get_running_loop()
+    progress_callback = make_progress_reporter(ctx, loop) if ctx else None
+    image_callback = make_image_reporter(ctx, loop) if ctx else None
+    drafts = []
     try:
-        # 调用核心生成函数
-        image_urls = generate_images(
-            prompt=prompt,
-            refresh_token=JIMENG_API_TOKEN,
-            model=final_model,
-            file_path=file_path
-        )
+        # 在线程中调用核心生成函数，多个调用可并发执行；MCP取消通知到达时立即停止上游轮询
+        async with generation_slots:
+            with tracing.span("mcp.generate_image", **{"jimeng.model": final_model}) as tool_span:
+                if tool_span is not None:
+                    logger.info(f"trace_id={tool_span.trace_id}")
+                image_urls = await asyncio.to_thread(
+                    generate_images,
+                    prompt=prompt,
+                    refresh_token=JIMENG_API_TOKEN,
+                    model=final_model,
+                    file_path=file_path,
+                    cancel_event=cancel_event,
+                    progress_callback=progress_callback,
+                    n=n,
+                    seed=seed,
+                    image_callback=image_callback,
+                    draft_callback=lambda history_id, urls: drafts.append((history_id, urls))
+                )
         if not image_urls:
              return [types.TextContent(text="**错误**: API未能返回任何图片URL。")]
         
-        # 格式化为Markdown并返回
+        # 格式化为Markdown并返回，配置了稳定地址时嵌入稳定地址，聊天记录中的图片不会随签名链接过期
+        if IMAGE_BASE_URL:
+            image_urls = [f"{IMAGE_BASE_URL}/images/{history_id}/{index}" for history_id, urls in drafts for index in range(len(urls))]
         markdown_output = "\n\n".join([f"![Generated Image]({url})" for url in image_urls])
-        logger.info(f"成功生成 {len(image_urls)} 张图片, 返回Markdown。")
+        JOB_STATS["completed"] += 1
+        logger.info(f"成功生成 {len(image_urls)} 张图片, 返回Markdown。任务统计: {JOB_STATS}")
         return [types.TextContent(text=markdown_output)]
-        
+
+    except asyncio.CancelledError:
+        cancel_event.set()
+        JOB_STATS["abandoned"] += 1
+        logger.warning(f"图片生成请求已被客户端取消，停止轮询。任务统计: {JOB_STATS}")
+        raise
     except Exception as e:
         error_msg = f"**图片生成过程中发生错误**: {str(e)}"
-        logger.exception(error_msg)
+        JOB_STATS["failed"] += 1
+        logger.exception(f"{error_msg} 任务统计: {JOB_STATS}")
         return [types.TextContent(text=error_msg)]
 
 if __name__ == "__main__":